@@ -3,15 +3,31 @@ import os
 import io
 import sys
 import json
+import gzip
+import zlib
+import mmap
+import struct
+import bisect
+import itertools
 import math
 import tempfile
+import random
+import hashlib
+import hmac
 from pathlib import Path
 import stat
+import ssl
+import threading
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlparse, urlencode
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 
 # Standard Library - Time/Date
 import time
-from datetime import datetime, timedelta,time as dt_time
+from datetime import datetime, timedelta,time as dt_time, timezone
 from zoneinfo import ZoneInfo
+from email.utils import parsedate_to_datetime
 
 # Standard Library - Data Processing
 import csv
@@ -22,7 +38,9 @@ import shutil
 # Third-party - Data Processing
 import pandas as pd
 import requests
+from requests.adapters import HTTPAdapter
 from collections import defaultdict
+from collections.abc import Sequence
 
 # Google Cloud Platform
 from google.auth import default
@@ -30,6 +48,7 @@ from google.auth.exceptions import DefaultCredentialsError
 from google.oauth2 import service_account
 from google.cloud import secretmanager, bigquery
 from google.cloud import storage
+from google.api_core.exceptions import PreconditionFailed
 import gspread
 
 debug = False
@@ -48,6 +67,154 @@ cascade_absencedays             = 'https://api.iris.co.uk/hr/v2/attendance/absen
 cascade_absence_reasons_url     = 'https://api.iris.co.uk/hr/v2/attendance/absencereasons?%24count=true'
 adp_events_url                  = 'https://api.adp.com/core/v1/event-notification-messages'
 
+cascade_index                   = {"NationalInsuranceNumber": {}, "Id": {}, "DisplayId": {}}      # Lookups over the Cascade worker snapshot
+
+# Connection pooling - one keep-alive pool per host, ADP pools carry the client certificate
+http_pool_connections           = 4             # Number of host pools held by each session
+http_pool_maxsize               = 20            # Keep-alive connections held open per host
+adp_hosts                       = ["accounts.adp.com", "api.adp.com"]
+http_sessions                   = {}            # host -> session currently in use
+adp_country_sessions            = {}            # country -> {host: session} (built once per certificate)
+http_sessions_lock              = threading.Lock()
+
+# Rate limiting - token bucket per host, rate grows on success and halves on 429/503 (AIMD)
+rate_limits = {
+    "api.adp.com":      {"rate": 1.6, "min_rate": 0.5, "max_rate": 10},
+    "api.iris.co.uk":   {"rate": 1.6, "min_rate": 0.5, "max_rate": 10},
+}
+default_rate_limit              = {"rate": 2, "min_rate": 0.5, "max_rate": 10}
+rate_limit_burst                = 5             # Requests that can be sent back to back after an idle spell
+rate_limit_increase             = 0.05          # Requests/second added after every success
+rate_limit_decrease             = 0.5           # Rate multiplier applied on 429/503
+rate_limit_retries              = 5             # Retries for a throttled request before the response is returned
+rate_limit_backoff              = 1.0           # Base backoff in seconds, doubled each retry with jitter
+rate_limiters                   = {}
+
+# Concurrency - number of requests in flight at once (keep within http_pool_maxsize)
+adp_page_workers                = 8             # ADP worker pages downloaded in parallel (1 = serial)
+adp_download_mode               = "walk"        # "walk" pages through each status with no count call, "pages" counts then fans out pages
+cascade_page_workers            = 6             # Cascade collection pages downloaded in parallel (1 = serial)
+absence_employee_workers        = 8             # Employees reconciled at once in run type 2 (1 = serial)
+absence_bulk_download           = True          # Overnight run type 2 downloads every Cascade absence in one paged query
+absence_bulk_cache              = {}            # date of absences_from -> absences_by_employee, shared by every country in a run
+event_batch_window              = 2.0           # Seconds events are coalesced by AOID before the batch is synced
+event_batch_size                = 50            # AOIDs waiting that release a batch straight away
+absence_sync_marks              = {}            # (country, AOID) -> time the last successful absence sync started
+absence_sync_marks_lock         = threading.Lock()
+event_clock_skew_seconds        = 120           # Taken off each sync mark so an event stamped by a fast ADP clock is still synced
+host_concurrency = {                            # Requests in flight per host, shared by every worker thread
+    "api.adp.com":      6,
+    "api.iris.co.uk":   6,
+}
+host_semaphores                 = {}
+hierarchy_filter_chunk          = 20            # Parent nodes combined into a single hierarchy filter
+hierarchy_fallback_code         = False         # Resolve a worker by job code alone when the pair is unmapped
+hierarchy_fallback_name         = False         # Resolve a worker by job name alone when the pair is unmapped
+
+# Writes - every Cascade PUT/POST/DELETE is queued through runWrites
+write_workers                   = 8             # Writes in flight at once for a single runWrites call
+write_concurrency = {                           # Writes in flight per endpoint, shared by every runWrites call
+    "cascade_workers":  4,
+    "cascade_jobs":     4,
+    "cascade_absences": 4,
+    "cascade_batch":    2,
+    "adp_custom_field": 6,
+}
+write_semaphores                = {}
+write_retries                   = 3             # Extra attempts for a write that keeps failing with a retryable status
+write_retry_statuses            = (429, 500, 502, 503, 504)     # Retried for PUT and DELETE
+write_post_retry_statuses       = (429,)        # POST is only retried when it was refused, so a record is never created twice
+cascade_batch_enabled           = False         # Group Cascade writes into OData JSON $batch requests
+cascade_batch_url               = 'https://api.iris.co.uk/hr/v2/$batch'
+cascade_batch_size              = 20            # Writes carried by a single $batch request
+cascade_batch_rejected          = False         # Set once Cascade refuses $batch - later writes are sent singly
+cascade_id_ledger               = "cascade_id_writeback_{country}.json"    # Bucket ledger of Cascade IDs already pushed to ADP (None = off)
+cascade_id_ledger_hours         = 12            # Ledger entries older than this are ignored, so the next overnight run trusts whatsInAdp again
+
+# Field projection - bulk downloads only ask for the fields a run type reads ($select).
+# Debug runs skip the projection so the exported files keep every raw field.
+cascade_worker_fields_common = [
+    "Id", "DisplayId", "NationalInsuranceNumber", "ContinuousServiceDate", "KnownAs", "LastName",
+]
+cascade_worker_fields_personal = cascade_worker_fields_common + [
+    "TitleHonorific", "FirstName", "OtherName", "CostCentre", "WorkingStatus", "IsManager", "PayrollId", "TaxCode",
+    "IncludeInPayroll", "EmploymentStartDate", "EmploymentLeftDate", "DateOfBirth", "LastWorkingDate", "Gender",
+    "Ethnicity", "Nationality", "Religion", "LeaverReason", "MaritalStatus", "Phones", "Emails", "Addresses",
+    "GenderIdentity", "WindowsUsername",
+]
+cascade_worker_fields = {
+    1: cascade_worker_fields_common,
+    2: cascade_worker_fields_common,
+    3: cascade_worker_fields_personal,
+    4: cascade_worker_fields_common,
+}
+cascade_job_fields = [
+    "Id", "EmployeeId", "JobTitle", "Classification", "StartDate", "EndDate", "LineManagerId", "HierarchyNodeId",
+    "Active", "Salary", "PayFrequency", "PayBasis", "ChangeReason", "NextIncrementDate", "TimesheetLocation",
+    "TimesheetLunchDuration", "ExpenseSubmissionFrequency", "CostCentre", "JobFamily", "ApprenticeUnder25",
+    "ApprenticeshipEndDate", "ContractEndDate", "NormalHours", "RealTimeInformationIrregularFrequency", "NoticePeriod",
+]
+adp_select_supported            = False         # Switch on once the ADP workers $select has been confirmed for the tenant
+adp_worker_fields_common        = ["associateOID", "workerID", "workAssignments"]
+adp_worker_fields = {
+    1: adp_worker_fields_common + ["person/customFieldGroup", "customFieldGroup"],
+    2: adp_worker_fields_common,
+    3: adp_worker_fields_common + ["person", "workerStatus", "businessCommunication", "customFieldGroup"],
+    4: adp_worker_fields_common,
+}
+select_rejected_urls            = set()         # Endpoints that refused a $select - called without one from then on
+
+# Tokens - cached per credential, refreshed in the background before they expire
+token_refresh_margin            = 300           # Seconds before expiry that a token is renewed
+token_default_lifetime          = 3600          # Used when the token response has no expires_in
+token_cache                     = {}            # credential key -> token details
+token_owners                    = {}            # token -> credential key (used to renew on a 401)
+active_tokens                   = {}            # global name (access_token/cascade_token) -> credential key in use
+token_lock                      = threading.RLock()
+
+# Google Cloud - long-lived clients and secrets are shared for the whole process
+gcp_clients                     = {}            # (service, project) -> client
+gcp_clients_lock                = threading.Lock()
+secret_cache                    = {}            # (secret_id, version_id) -> (value, fetched at)
+secret_cache_seconds            = 3600          # How long a secret value is reused before it is fetched again
+secret_workers                  = 8             # Secrets fetched in parallel by loadKeys
+hierarchy_spreadsheet           = None          # Hierarchy gsheet, opened once per process
+
+# Bucket workbooks - parsed once per GCS object generation
+workbook_bucket                 = "event_list_objects"
+workbook_check_seconds          = 300           # How long a parsed workbook is served before its generation is checked again
+workbook_cache_dir              = None          # Folder for an on-disk copy of parsed workbooks (None = memory only)
+workbook_cache                  = {}            # name -> {"generation", "sheets", "checked"}
+workbook_lock                   = threading.Lock()
+page_fetch_attempts             = 3             # Passes made over failed pages before the download is abandoned
+
+# Personal data reconciliation (run type 3)
+personal_update_trigger         = "status"      # "status" PUTs records whose WorkingStatus moved, "any" PUTs every changed record
+personal_ignored_fields         = ("Initials",) # Fields left out of the record fingerprint
+
+# Debug exports - exportData buffers each file and flushExports writes it once per stage in the background
+export_indent                   = None          # None = compact json, 4 = the old pretty-printed files
+export_format                   = "json"        # "json", or "ndjson" to write lists one record per line (.ndjson)
+export_compress                 = False         # gzip the exported files (.gz)
+export_buffer                   = {}            # file path -> (path written, serialised text, snapshot blocks) of the latest export
+export_lock                     = threading.Lock()
+export_executor                 = ThreadPoolExecutor(max_workers=1)
+export_futures                  = []
+
+# Snapshots - block compressed NDJSON with an offset index, memory-mapped by load() in testing mode
+snapshot_exports                = False         # List exports (and loads) of snapshot_min_records or more are also written as .snap
+snapshot_min_records            = 1000
+snapshot_block_records          = 500           # Records per compressed block
+snapshot_lazy                   = False         # load() leaves a snapshot as a memory-mapped view instead of building a list
+snapshot_magic                  = b"ADPSNAP1"
+
+# Service mode (--serve) - stays resident and runs the event driven absence sync on request
+service_library_check_seconds   = 900           # How long /absences reuses a loaded ID library - /trigger always reloads it
+service_libraries               = {}            # country -> {"library", "loaded"}
+service_token                   = os.environ.get("SERVICE_TOKEN")  # Shared token callers send as "Authorization: Bearer" or "X-Service-Token" - POSTs are refused without it
+country_state                   = {}            # country -> keys and certificate paths, loaded once per process
+service_lock                    = threading.Lock()  # Country globals are shared, so one sync runs at a time
+
 SCOPES = [
     "https://www.googleapis.com/auth/spreadsheets",
     "https://www.googleapis.com/auth/drive",
@@ -198,19 +365,215 @@ def deleteFolders():
     time.sleep(1)
 
 def exportData(folder, filename, variable):
-    ''' Exports a given json list stored as a variable to a folder and filename'''  
+    ''' Exports a given json list stored as a variable to a folder and filename.
+        The variable is serialised on every call, so later changes to it are not written - export once a list
+        is complete, not from inside the loop that builds it. The file is written by the next flushExports.'''  
 
     if data_export:
         file_path = Path(data_store) / folder / filename
-        with open(file_path, "w") as outfile:
-            json.dump(variable, outfile, indent=4)
+        ndjson = export_format == "ndjson" and isinstance(variable, list)
+        text = serialiseExport(variable, ndjson)
+        blocks = None
+        if snapshot_exports and isinstance(variable, list) and len(variable) >= snapshot_min_records:
+            blocks = snapshotBlocks(variable)
+
+        with export_lock:
+            export_buffer[file_path] = (exportPath(file_path, variable), text, blocks)
+
+def exportPath(file_path, variable=None):
+    ''' Works out the name an export is written to for the configured format and compression
+
+    Args:   file_path (Path): path given to exportData
+            variable: the data being written - ndjson only applies to lists
+
+    Return: file_path (Path)
+    '''
+    if export_format == "ndjson" and isinstance(variable, list):
+        file_path = file_path.with_suffix(".ndjson")
+    if export_compress:
+        file_path = file_path.with_name(file_path.name + ".gz")
+    return file_path
+
+def exportDefault(value):
+    '''json fallback for exports - snapshot views are written as lists, anything else as text'''
+    if isinstance(value, SnapshotList):
+        return list(value)
+    return str(value)
+
+def serialiseExport(variable, ndjson):
+    '''Turns an exported variable into the text written to disk'''
+    separators = None if export_indent else (",", ":")
+    if ndjson:
+        return "".join(json.dumps(item, separators=(",", ":"), default=exportDefault) + "\n" for item in variable)
+    return json.dumps(variable, indent=export_indent, separators=separators, default=exportDefault)
+
+def writeExport(file_path, text):
+    '''Writes one serialised export - runs on the export thread'''
+    try:
+        opener = gzip.open if export_compress else open
+        with opener(file_path, "wt", encoding="utf-8") as outfile:
+            outfile.write(text)
+    except OSError as e:
+        print(f"        Could not write {file_path}: {e}")
+
+def flushExports(wait=False):
+    ''' Writes every buffered export. The text was serialised by exportData, so only the compression
+        and disk writes are left, and they run on the export thread.
+
+    Args:   wait (bool): Block until every export has been written (end of run)
+    '''
+    with export_lock:
+        pending = list(export_buffer.items())
+        export_buffer.clear()
+
+    export_futures[:] = [future for future in export_futures if not future.done()]
+
+    for file_path, (export_path, text, blocks) in pending:
+        export_futures.append(export_executor.submit(writeExport, export_path, text))
+
+        if blocks is not None:
+            export_futures.append(export_executor.submit(writeSnapshot, snapshotPath(file_path), blocks))
+
+    if wait:
+        for future in export_futures:
+            future.result()
+        export_futures.clear()
+
+def snapshotPath(file_path):
+    '''Returns the snapshot that sits beside an export'''
+    return file_path.with_suffix(".snap")
+
+def snapshotBlocks(records):
+    ''' Splits a list into NDJSON blocks of snapshot_block_records, ready for writeSnapshot
+
+    Args:   records (list): records to snapshot
+
+    Return: blocks (list): (ndjson text, record count) per block
+    '''
+    blocks = []
+    for start in range(0, len(records), snapshot_block_records):
+        chunk = records[start:start + snapshot_block_records]
+        text = "".join(json.dumps(record, separators=(",", ":"), default=exportDefault) + "\n" for record in chunk)
+        blocks.append((text, len(chunk)))
+    return blocks
+
+def writeSnapshot(file_path, blocks):
+    ''' Writes a snapshot - the magic bytes, one zlib block per group of records, then a json index of
+        [offset, length, records] per block and the index offset as the last 8 bytes.
+        The file is written beside its final name and swapped in, so a reader never sees half a snapshot.
+
+    Args:   file_path (Path): .snap file to write
+            blocks (list): (ndjson text, record count) pairs from snapshotBlocks
+    '''
+    temp_path = file_path.with_name(file_path.name + ".tmp")
+    try:
+        with open(temp_path, "wb") as snapshot:
+            snapshot.write(snapshot_magic)
+            index = []
+            for text, count in blocks:
+                data = zlib.compress(text.encode("utf-8"), 6)
+                index.append([snapshot.tell(), len(data), count])
+                snapshot.write(data)
+
+            index_offset = snapshot.tell()
+            snapshot.write(json.dumps({"count": sum(b[2] for b in index), "blocks": index}).encode("utf-8"))
+            snapshot.write(struct.pack("<Q", index_offset))
+        os.replace(temp_path, file_path)
+    except OSError as e:
+        print(f"        Could not write snapshot {file_path}: {e}")
+
+class SnapshotList(Sequence):
+    ''' Read-only list view of a snapshot file.
+        The file is memory-mapped and a block is only decompressed when it is reached, so a replay never holds
+        the whole dump in memory. Records are decoded afresh on each pass - changes to them are not kept.
+    '''
+
+    def __init__(self, file_path):
+        with open(file_path, "rb") as snapshot:
+            self.map = mmap.mmap(snapshot.fileno(), 0, access=mmap.ACCESS_READ)
+
+        if self.map[:len(snapshot_magic)] != snapshot_magic:
+            self.map.close()
+            raise ValueError(f"{file_path} is not a snapshot")
+
+        (index_offset,) = struct.unpack("<Q", self.map[-8:])
+        index = json.loads(self.map[index_offset:len(self.map) - 8])
+        self.blocks = index["blocks"]
+        self.count = index["count"]
+        self.starts = [0] + list(itertools.accumulate(block[2] for block in self.blocks))[:-1]
+        self.cached = (None, None)                                      # (block number, records) of the last block indexed
+
+    def close(self):
+        self.cached = (None, None)
+        self.map.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def decodeBlock(self, number):
+        offset, length, _ = self.blocks[number]
+        text = zlib.decompress(self.map[offset:offset + length]).decode("utf-8")
+        return [json.loads(line) for line in text.splitlines() if line]
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, position):
+        if isinstance(position, slice):
+            return [self[i] for i in range(*position.indices(self.count))]
+        if position < 0:
+            position += self.count
+        if not 0 <= position < self.count:
+            raise IndexError("snapshot index out of range")
+
+        number = bisect.bisect_right(self.starts, position) - 1
+        cached_number, records = self.cached
+        if cached_number != number:
+            records = self.decodeBlock(number)
+            self.cached = (number, records)
+        return records[position - self.starts[number]]
+
+    def __iter__(self):
+        for number in range(len(self.blocks)):
+            yield from self.decodeBlock(number)
 
 def load(folder,filename,variable_name):
-    ''' Imports a json list from folder and filename to a global variable'''  
+    ''' Imports a json list from folder and filename to a global variable.
+        A snapshot (.snap) at least as new as the export is preferred and read into a list (with snapshot_lazy
+        the memory-mapped view is kept instead). Otherwise whichever form the export was written in is read -
+        json, ndjson, or either gzipped - and with snapshot_exports a large list is snapshotted in the
+        background so the next replay is fast.'''  
 
     file_path = Path(data_store) / folder / filename
-    with open(file_path,"r") as file:
-        globals()[variable_name] = json.load(file)
+    ndjson_path = file_path.with_suffix(".ndjson")
+    candidates = [file_path, file_path.with_name(file_path.name + ".gz"), ndjson_path, ndjson_path.with_name(ndjson_path.name + ".gz")]
+    source_path = next((p for p in candidates if p.exists()), file_path)
+
+    snapshot_path = snapshotPath(file_path)
+    if snapshot_path.exists() and (not source_path.exists() or snapshot_path.stat().st_mtime >= source_path.stat().st_mtime):
+        snapshot = SnapshotList(snapshot_path)
+        if snapshot_lazy:
+            globals()[variable_name] = snapshot
+            return
+        with snapshot:
+            globals()[variable_name] = list(snapshot)
+        return
+
+    opener = gzip.open if source_path.suffix == ".gz" else open
+    with opener(source_path,"rt",encoding="utf-8") as file:
+        if ".ndjson" in source_path.suffixes:
+            data = [json.loads(line) for line in file if line.strip()]
+        else:
+            data = json.load(file)
+
+    globals()[variable_name] = data
+
+    if snapshot_exports and isinstance(data, list) and len(data) >= snapshot_min_records:
+        records = list(data)                                                    # The caller may change the list while the snapshot is built
+        export_futures.append(export_executor.submit(lambda: writeSnapshot(snapshot_path, snapshotBlocks(records))))
     
 def googleAuth():
     ''' Authentificates with the google cloud services.
@@ -280,17 +643,53 @@ def dataStoreLocation(country):
     folder_name = f"Data - {country.upper()}"
     return os.path.join(current_folder, "Data Store", folder_name)
 
+def getGcpClient(service, credentials=None, project_id=None):
+    ''' Returns the process-wide client for a Google Cloud service, creating it on first use
+
+    Args:   service (str): secretmanager, bigquery, storage or gspread
+            credentials, project_id: Defaults to the credentials from googleAuth
+
+    Return: client for the requested service
+    '''
+    credentials = credentials or creds
+    project_id = project_id or project_Id
+    key = (service, project_id)
+
+    with gcp_clients_lock:
+        client = gcp_clients.get(key)
+        if client is None:
+            if service == "secretmanager":
+                client = secretmanager.SecretManagerServiceClient(credentials=credentials)
+            elif service == "bigquery":
+                client = bigquery.Client(project=project_id, credentials=credentials)
+            elif service == "storage":
+                client = storage.Client(credentials=credentials, project=project_id)
+            elif service == "gspread":
+                client = gspread.authorize(credentials)
+            else:
+                raise ValueError(f"Unknown Google Cloud service: {service}")
+            gcp_clients[key] = client
+        return client
+
 def getSecret(secret_id, version_id="latest"):
-    ''' Downloads secretvalue from Google Secret Manager
+    ''' Downloads secretvalue from Google Secret Manager.
+        Values are cached for secret_cache_seconds so secrets shared by both countries are only fetched once.
 
     Args: Secret_id (Str), version_id set as latest as default
     Returns: Value of secret (Str)
     
     '''
-    client = secretmanager.SecretManagerServiceClient(credentials=creds)
+    cached = secret_cache.get((secret_id, version_id))
+    if cached is not None and time.time() - cached[1] < secret_cache_seconds:
+        return cached[0]
+
+    client = getGcpClient("secretmanager")
     name = f"projects/{project_Id}/secrets/{secret_id}/versions/{version_id}"
     response = client.access_secret_version(request={"name": name})
-    return response.payload.data.decode("UTF-8")
+    value = response.payload.data.decode("UTF-8")
+
+    secret_cache[(secret_id, version_id)] = (value, time.time())
+    return value
 
 def loadKeys(country):
     ''' Iterates through a list of secret values and calls the getSecret function.
@@ -315,7 +714,8 @@ def loadKeys(country):
         "certfile": f"{country}_cert_pem",
     }
 
-    secrets = {k: getSecret(v) for k, v in secret_ids.items()}
+    with ThreadPoolExecutor(max_workers=max(1, secret_workers)) as executor:
+        secrets = dict(zip(secret_ids.keys(), executor.map(getSecret, secret_ids.values())))
 
     return (
         secrets["client_id"],
@@ -357,6 +757,440 @@ def loadSsl(certfile_content, keyfile_content):
         os.unlink(temp_keyfile.name)
         raise e
 
+# HTTP Sessions
+
+class SslContextAdapter(HTTPAdapter):
+    ''' Transport adapter that hands a prebuilt SSL context to every pooled connection.
+        Lets the ADP client certificate be loaded once rather than on every request.'''
+
+    def __init__(self, ssl_context=None, **kwargs):
+        self.ssl_context = ssl_context
+        super().__init__(**kwargs)
+
+    def init_poolmanager(self, *args, **kwargs):
+        if self.ssl_context is not None:
+            kwargs["ssl_context"] = self.ssl_context
+        return super().init_poolmanager(*args, **kwargs)
+
+def buildSslContext(certfile, keyfile):
+    ''' Builds a reusable SSL context holding the ADP client certificate
+
+    Args:   certfile, keyfile (str): Paths to the temporary files generated by loadSsl
+
+    Return: ssl_context (SSLContext): Verified TLS context with the client cert chain loaded
+    '''
+    ssl_context = ssl.create_default_context()
+    ssl_context.load_cert_chain(certfile=certfile, keyfile=keyfile)
+    return ssl_context
+
+def createSession(ssl_context=None):
+    ''' Creates a keep-alive session with a connection pool sized from http_pool_connections/http_pool_maxsize
+
+    Args:   ssl_context (SSLContext): Client certificate context for mTLS hosts - Nullable
+
+    Return: session (requests.Session)
+    '''
+    adapter = SslContextAdapter(
+        ssl_context=ssl_context,
+        pool_connections=http_pool_connections,
+        pool_maxsize=http_pool_maxsize,
+    )
+    session = requests.Session()
+    session.mount("https://", adapter)
+    return session
+
+def startSessions(country, certfile, keyfile):
+    ''' Activates the pooled sessions for a country. ADP sessions are mTLS and country specific,
+        so they are built once per country and reused if the country is visited again.
+        The Cascade session is shared by every country.
+
+    Args:   country (str): usa or can
+            certfile, keyfile (str): Paths to the temporary files generated by loadSsl
+    '''
+    if country not in adp_country_sessions:
+        ssl_context = buildSslContext(certfile, keyfile)
+        adp_country_sessions[country] = {host: createSession(ssl_context) for host in adp_hosts}
+
+    http_sessions.update(adp_country_sessions[country])
+
+class RateLimiter:
+    ''' Token bucket for a single host with AIMD rate adjustment.
+
+        Successes add rate_limit_increase to the rate, 429/503 responses multiply it by rate_limit_decrease.
+        A Retry-After header pauses the host until it has passed.
+    '''
+
+    def __init__(self, rate, min_rate, max_rate, burst):
+        self.rate = rate
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        '''Blocks until a request can be sent to the host'''
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+
+                wait = self.paused_until - now
+                if wait <= 0:
+                    if self.tokens >= 1:
+                        self.tokens -= 1
+                        return
+                    wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+    def success(self):
+        '''Additive increase after a request that was not throttled'''
+        with self.lock:
+            self.rate = min(self.max_rate, self.rate + rate_limit_increase)
+
+    def throttled(self, retry_after=None):
+        '''Multiplicative decrease after a 429/503, pausing the host for Retry-After if given'''
+        with self.lock:
+            self.rate = max(self.min_rate, self.rate * rate_limit_decrease)
+            self.tokens = 0
+            if retry_after is not None:
+                self.paused_until = max(self.paused_until, time.monotonic() + retry_after)
+
+def getRateLimiter(host):
+    '''Returns the shared rate limiter for a host, creating it from rate_limits on first use'''
+
+    limiter = rate_limiters.get(host)
+    if limiter is None:
+        with http_sessions_lock:
+            if host not in rate_limiters:
+                settings = rate_limits.get(host, default_rate_limit)
+                rate_limiters[host] = RateLimiter(settings["rate"], settings["min_rate"], settings["max_rate"], rate_limit_burst)
+            limiter = rate_limiters[host]
+    return limiter
+
+def getHostSemaphore(host):
+    '''Returns the semaphore capping concurrent requests to a host - None if the host is not limited'''
+
+    if host not in host_concurrency:
+        return None
+
+    semaphore = host_semaphores.get(host)
+    if semaphore is None:
+        with http_sessions_lock:
+            semaphore = host_semaphores.setdefault(host, threading.BoundedSemaphore(host_concurrency[host]))
+    return semaphore
+
+def retryAfterSeconds(response):
+    ''' Reads the Retry-After header, which can be a number of seconds or an HTTP date
+
+    Return: seconds (float): Time to wait before retrying - None if the header is missing or unreadable
+    '''
+    retry_after = response.headers.get("Retry-After")
+    if not retry_after:
+        return None
+
+    try:
+        return max(0.0, float(retry_after))
+    except ValueError:
+        pass
+
+    try:
+        retry_at = parsedate_to_datetime(retry_after)
+        return max(0.0, (retry_at - datetime.now(retry_at.tzinfo)).total_seconds())
+    except (TypeError, ValueError):
+        return None
+
+def hostOf(url):
+    '''Returns the host name for a url - used to pick the session'''
+    return urlparse(url).hostname
+
+def httpRequest(method, url, **kwargs):
+    ''' Sends a request through the pooled session for the url's host
+
+    Args:   method (str): GET, POST, PUT or DELETE
+            url (str): Full url for the endpoint
+            **kwargs: Passed through to requests (headers, params, json, data)
+
+    Throttled responses (429/503) are retried through the host's rate limiter - a POST only on 429, as a
+    503 can come back after the record was written - and a 401 on a managed bearer token is retried once
+    with a renewed token.
+
+    Return: response (requests.Response)
+    '''
+    host = hostOf(url)
+    session = http_sessions.get(host)
+
+    if session is None:
+        with http_sessions_lock:
+            session = http_sessions.setdefault(host, createSession())
+
+    response = sendWithRetries(session, host, method, url, **kwargs)
+
+    if response.status_code == 401:
+        headers = kwargs.get("headers") or {}
+        renewed = renewTokenAfter401(headers.get("Authorization", ""))
+        if renewed is not None:
+            print(f"            401 from {host}, retrying with a renewed token")
+            kwargs["headers"] = {**headers, "Authorization": f"Bearer {renewed}"}
+            response = sendWithRetries(session, host, method, url, **kwargs)
+
+    return response
+
+def sendWithRetries(session, host, method, url, **kwargs):
+    '''Sends a request under the host's concurrency cap and rate limiter, retrying 429/503 responses (POST: 429 only)'''
+
+    limiter = getRateLimiter(host)
+    semaphore = getHostSemaphore(host)
+
+    for attempt in range(rate_limit_retries + 1):
+        if semaphore is not None:
+            semaphore.acquire()
+        try:
+            limiter.acquire()
+            response = session.request(method, url, **kwargs)
+        finally:
+            if semaphore is not None:
+                semaphore.release()
+
+        if response.status_code not in (429, 503):
+            limiter.success()
+            return response
+
+        retry_after = retryAfterSeconds(response)
+        limiter.throttled(retry_after)
+
+        if method == "POST" and response.status_code != 429:
+            return response
+
+        if attempt < rate_limit_retries:
+            print(f"            {response.status_code} from {host}, retrying ({attempt + 1}/{rate_limit_retries})")
+            if retry_after is None:                                             # Retry-After is enforced by the limiter pause
+                backoff = rate_limit_backoff * (2 ** attempt)
+                time.sleep(random.uniform(backoff / 2, backoff))
+
+    return response
+
+def closeSessions():
+    '''Closes every pooled connection at the end of a run'''
+
+    for sessions in adp_country_sessions.values():
+        for session in sessions.values():
+            session.close()
+    for session in http_sessions.values():
+        session.close()
+
+    adp_country_sessions.clear()
+    http_sessions.clear()
+
+# Writes
+
+def getWriteSemaphore(endpoint):
+    '''Returns the semaphore capping concurrent writes to an endpoint - None if the endpoint is not limited'''
+
+    if endpoint not in write_concurrency:
+        return None
+
+    semaphore = write_semaphores.get(endpoint)
+    if semaphore is None:
+        with http_sessions_lock:
+            semaphore = write_semaphores.setdefault(endpoint, threading.BoundedSemaphore(write_concurrency[endpoint]))
+    return semaphore
+
+def writeOperation(key, method, url, endpoint, ok_statuses, **kwargs):
+    ''' Describes one queued write for runWrites
+
+    Args:   key (str): Identifies the record in the outcome report, e.g. a DisplayId or absence id
+            method (str): PUT, POST or DELETE
+            url (str): Full url for the endpoint
+            endpoint (str): write_concurrency entry that limits this write
+            ok_statuses (tuple): Status codes that count as success
+            **kwargs: Passed through to httpRequest (headers, params, json)
+
+    Return: operation (dict)
+    '''
+    return {"key": key, "method": method, "url": url, "endpoint": endpoint, "ok_statuses": ok_statuses, "kwargs": kwargs}
+
+class BatchSubResponse:
+    ''' One response from inside a $batch reply, shaped like requests.Response for the callers of runWrites'''
+
+    __slots__ = ("status_code", "headers", "body")
+
+    def __init__(self, item):
+        self.status_code = int(item.get("status") or 0)
+        self.headers = item.get("headers") or {}
+        self.body = item.get("body")
+
+    def json(self):
+        if isinstance(self.body, (str, bytes)):
+            return json.loads(self.body)
+        if self.body is None:
+            raise json.JSONDecodeError("Expecting value", "", 0)
+        return self.body
+
+def isBatchable(operation):
+    '''True when a write can travel inside a Cascade $batch request'''
+    return cascade_batch_enabled and not cascade_batch_rejected and hostOf(operation["url"]) == hostOf(cascade_batch_url)
+
+def sendWriteBatch(batch):
+    ''' Sends a group of writes as one OData JSON $batch request and maps each sub-response back by id.
+        Sub-requests that come back with a retryable status are left out of the result so runWrites sends them
+        singly. If the batch never reached Cascade (ConnectTimeout) or was refused (400/404/405/415/501 - which
+        also switches batching off for the run) every write is sent singly. Any other failure leaves the batch's
+        outcome unknown: PUTs and DELETEs are sent singly, but POSTs are reported as failed and not re-sent, as
+        Cascade may already have created them.
+
+    Args:   batch (list): (index, operation) pairs
+
+    Return: outcomes (dict): index -> outcome for every write the batch settled
+    '''
+    global cascade_batch_rejected
+
+    def unknown(operations, error):
+        return {index: {"key": operation["key"], "method": operation["method"], "url": operation["url"],
+                        "status": None, "ok": False, "attempts": 1, "error": error, "response": None}
+                for index, operation in operations if operation["method"] == "POST"}
+
+    batch_requests = []
+    for index, operation in batch:
+        kwargs = operation["kwargs"]
+        url = operation["url"]
+        if kwargs.get("params"):
+            url += ("&" if "?" in url else "?") + urlencode(kwargs["params"])
+        headers = {k: v for k, v in (kwargs.get("headers") or {}).items() if k.lower() not in ("authorization", "content-length")}
+
+        sub_request = {"id": str(index), "method": operation["method"], "url": url, "headers": headers}
+        if "json" in kwargs:
+            sub_request["body"] = kwargs["json"]
+        batch_requests.append(sub_request)
+
+    headers = {
+        "Authorization": (batch[0][1]["kwargs"].get("headers") or {}).get("Authorization"),
+        "Content-Type": "application/json",
+        "Accept": "application/json",
+    }
+
+    semaphore = getWriteSemaphore("cascade_batch")
+    if semaphore is not None:
+        semaphore.acquire()
+    try:
+        response = httpRequest("POST", cascade_batch_url, headers=headers, data=json.dumps({"requests": batch_requests}))
+    except requests.ConnectTimeout as e:
+        print(f"            $batch could not connect, sending {len(batch)} writes singly: {e}")
+        return {}
+    except requests.RequestException as e:
+        print(f"            $batch request failed, POSTs in it are not re-sent: {e}")
+        return unknown(batch, f"batch outcome unknown: {e}")
+    finally:
+        if semaphore is not None:
+            semaphore.release()
+
+    if response.status_code in (400, 404, 405, 415, 501):
+        cascade_batch_rejected = True
+        print(f"            Cascade rejected $batch ({response.status_code}), sending writes singly")
+        return {}
+    if response.status_code != 200:
+        print(f"            $batch returned {response.status_code}, POSTs in it are not re-sent")
+        return unknown(batch, f"batch outcome unknown: status {response.status_code}")
+
+    try:
+        sub_responses = {str(item.get("id")): item for item in response.json().get("responses", [])}
+    except (ValueError, AttributeError):
+        print(f"            $batch reply could not be read, POSTs in it are not re-sent")
+        return unknown(batch, "batch outcome unknown: unreadable reply")
+
+    outcomes = unknown([(index, operation) for index, operation in batch if str(index) not in sub_responses],
+                       "batch outcome unknown: no sub-response")
+    for index, operation in batch:
+        item = sub_responses.get(str(index))
+        if item is None:
+            continue
+
+        sub_response = BatchSubResponse(item)
+        ok = sub_response.status_code in operation["ok_statuses"]
+        retry_statuses = write_post_retry_statuses if operation["method"] == "POST" else write_retry_statuses
+        if not ok and sub_response.status_code in retry_statuses:
+            continue
+
+        outcomes[index] = {"key": operation["key"], "method": operation["method"], "url": operation["url"],
+                           "status": sub_response.status_code, "ok": ok, "attempts": 1, "error": None, "response": sub_response}
+    return outcomes
+
+def runWrites(operations):
+    ''' Runs queued writes concurrently, capped per endpoint, retrying retryable failures with backoff.
+        Throttling is handled first by httpRequest; a write that is still refused afterwards is retried here
+        up to write_retries times. POSTs are only retried on write_post_retry_statuses, or when the connection
+        could not be made (ConnectTimeout) - any later failure may have reached the server.
+        When cascade_batch_enabled is set, Cascade writes are first grouped into $batch requests of
+        cascade_batch_size, and anything the batches do not settle falls back to single requests - a POST
+        whose batch outcome is unknown is reported as failed instead (sendWriteBatch).
+
+    Args:   operations (list): Writes built by writeOperation
+
+    Return: outcomes (list): One dict per operation, in the order given -
+                             key, method, url, status, ok, attempts, error and the final response
+    '''
+
+    def execute(operation):
+        method = operation["method"]
+        retry_statuses = write_post_retry_statuses if method == "POST" else write_retry_statuses
+        semaphore = getWriteSemaphore(operation["endpoint"])
+        outcome = {"key": operation["key"], "method": method, "url": operation["url"],
+                   "status": None, "ok": False, "attempts": 0, "error": None, "response": None}
+
+        for attempt in range(write_retries + 1):
+            outcome["attempts"] = attempt + 1
+            retryable = False
+
+            if semaphore is not None:
+                semaphore.acquire()
+            try:
+                response = httpRequest(method, operation["url"], **operation["kwargs"])
+            except requests.RequestException as e:
+                outcome["error"] = str(e)
+                retryable = method != "POST" or isinstance(e, requests.ConnectTimeout)
+            else:
+                outcome.update(status=response.status_code, response=response, error=None)
+                if response.status_code in operation["ok_statuses"]:
+                    outcome["ok"] = True
+                    return outcome
+                retryable = response.status_code in retry_statuses
+            finally:
+                if semaphore is not None:
+                    semaphore.release()
+
+            if not retryable or attempt == write_retries:
+                break
+
+            backoff = rate_limit_backoff * (2 ** attempt)
+            time.sleep(random.uniform(backoff / 2, backoff))
+
+        return outcome
+
+    if not operations:
+        return []
+
+    outcomes = [None] * len(operations)
+
+    with ThreadPoolExecutor(max_workers=max(1, min(write_workers, len(operations)))) as executor:
+        batchable = [(i, operation) for i, operation in enumerate(operations) if isBatchable(operation)]
+        batches = [batchable[i:i + cascade_batch_size] for i in range(0, len(batchable), max(1, cascade_batch_size))]
+        for settled in executor.map(sendWriteBatch, batches):
+            for index, outcome in settled.items():
+                outcomes[index] = outcome
+
+        single = [i for i, outcome in enumerate(outcomes) if outcome is None]
+        for index, outcome in zip(single, executor.map(execute, [operations[i] for i in single])):
+            outcomes[index] = outcome
+
+    return outcomes
+
+def writeReport(outcomes):
+    '''Strips the response objects so an outcome list can be exported'''
+    return [{k: v for k, v in outcome.items() if k != "response"} for outcome in outcomes]
+
 def adpBearer(client_id,client_secret,certfile,keyfile):
     ''' Retrieves the ADP OAuth access token
 
@@ -365,6 +1199,7 @@ def adpBearer(client_id,client_secret,certfile,keyfile):
             certfile, keyfile (None): SSL certificate - generated from secret manager
 
     Return: access_token (str)
+            expires_in (int): Lifetime of the token in seconds
             
     '''
     adp_token_url = 'https://accounts.adp.com/auth/oauth/v2/token'                                                                                          
@@ -377,18 +1212,22 @@ def adpBearer(client_id,client_secret,certfile,keyfile):
     adp_headers = {
         'Content-Type': 'application/x-www-form-urlencoded',
     }
-    adp_token_response = requests.post(adp_token_url, cert=(certfile, keyfile), verify=True, data=adp_token_data, headers=adp_headers)
+    adp_token_response = httpRequest("POST", adp_token_url, data=adp_token_data, headers=adp_headers)
 
-    if adp_token_response.status_code == 200:
-        access_token = adp_token_response.json()['access_token']
+    if adp_token_response.status_code != 200:
+        raise RuntimeError(f"ADP token request failed: {adp_token_response.status_code}")
 
-    return access_token
+    token_data = adp_token_response.json()
+    access_token = token_data['access_token']
+
+    return access_token, int(token_data.get('expires_in') or token_default_lifetime)
 
 def cascadeBearer (cascade_API_id):
     ''' Retrieves the Cascade OAuth access token
     
     Args:   Cascade_API_Id (str)
     Return: cascade_token (str)
+            expires_in (int): Lifetime of the token in seconds
 
     '''
     cascade_token_url='https://api.iris.co.uk/oauth2/v1/token'
@@ -401,13 +1240,117 @@ def cascadeBearer (cascade_API_id):
         "Authorization": f'Basic:{cascade_API_id}'
             }
 
-    cascade_token_response = requests.post(cascade_token_url, data=cascade_token_data, headers=cascade_headers)
+    cascade_token_response = httpRequest("POST", cascade_token_url, data=cascade_token_data, headers=cascade_headers)
 
     #checks the api response and extracts the bearer token
-    if cascade_token_response.status_code == 200:
-        cascade_token = cascade_token_response.json()['access_token']
+    if cascade_token_response.status_code != 200:
+        raise RuntimeError(f"Cascade token request failed: {cascade_token_response.status_code}")
+
+    token_data = cascade_token_response.json()
+    cascade_token = token_data['access_token']
     
-    return cascade_token
+    return cascade_token, int(token_data.get('expires_in') or token_default_lifetime)
+
+# Tokens
+
+def credentialKey(*parts):
+    '''Builds a cache key for a credential without keeping the secret itself'''
+    return hashlib.sha256("\x00".join(parts).encode("utf-8")).hexdigest()
+
+def getToken(key, fetch, global_name):
+    ''' Returns the bearer token for a credential, reusing a cached token until it is close to expiry.
+        The token is also written to the named global (access_token/cascade_token) used to build headers.
+
+    Args:   key (str): Credential key from credentialKey
+            fetch (function): Returns (token, expires_in) - adpBearer/cascadeBearer
+            global_name (str): Global that holds the token for the current country
+
+    Return: token (str)
+    '''
+    with token_lock:
+        active_tokens[global_name] = key
+        entry = token_cache.get(key)
+
+        if entry is None or entry["expires_at"] - token_refresh_margin <= time.time():
+            entry = refreshToken(key, fetch, global_name)
+
+        globals()[global_name] = entry["token"]
+        return entry["token"]
+
+def refreshToken(key, fetch=None, global_name=None):
+    ''' Fetches a new token for a credential and schedules the next background refresh
+
+    Return: entry (dict): Cached token details
+    '''
+    with token_lock:
+        entry = token_cache.setdefault(key, {"timer": None})
+        entry["fetch"] = fetch or entry["fetch"]
+        entry["global_name"] = global_name or entry["global_name"]
+
+        token, expires_in = entry["fetch"]()
+
+        entry["token"] = token
+        entry["expires_at"] = time.time() + expires_in
+        token_owners[token] = key
+
+        if entry["timer"] is not None:
+            entry["timer"].cancel()
+        entry["timer"] = threading.Timer(max(1, expires_in - token_refresh_margin), backgroundTokenRefresh, args=(key,))
+        entry["timer"].daemon = True
+        entry["timer"].start()
+
+        if active_tokens.get(entry["global_name"]) == key:
+            globals()[entry["global_name"]] = token
+
+        return entry
+
+def backgroundTokenRefresh(key):
+    ''' Timer callback that renews a token before it expires. Tokens for a country that is no longer
+        active are left to expire and renewed by getToken when that country is next used.'''
+
+    with token_lock:
+        entry = token_cache.get(key)
+        if entry is None or active_tokens.get(entry["global_name"]) != key:
+            return
+        try:
+            refreshToken(key)
+            print(f"        Token renewed in the background ({entry['global_name']})")
+        except Exception as e:
+            print(f"        Background token renewal failed ({entry['global_name']}): {e}")
+
+def renewTokenAfter401(authorization):
+    ''' Renews the token behind a rejected Authorization header
+
+    Args:   authorization (str): Authorization header of the request that returned 401
+
+    Return: token (str): Token to retry with - None if the header is not a managed, active token
+    '''
+    if not authorization.startswith("Bearer "):
+        return None
+
+    rejected = authorization[len("Bearer "):]
+
+    with token_lock:
+        key = token_owners.get(rejected)
+        entry = token_cache.get(key)
+        if entry is None or active_tokens.get(entry["global_name"]) != key:
+            return None
+
+        if entry["token"] != rejected:                                          # Another thread has already renewed it
+            return entry["token"]
+
+        try:
+            return refreshToken(key)["token"]
+        except Exception as e:
+            print(f"        Token renewal after 401 failed: {e}")
+            return None
+
+def stopTokenRefresh():
+    '''Cancels the background refresh timers at the end of a run'''
+    with token_lock:
+        for entry in token_cache.values():
+            if entry.get("timer") is not None:
+                entry["timer"].cancel()
 
 # API Calls
 
@@ -428,14 +1371,14 @@ def apiCountAdp(page_size,url,headers,type):
             "count": "true",
         }
     
-    api_count_response = requests.get(url, cert=(certfile, keyfile), verify=True, headers=headers, params=api_count_params) 
+    api_count_response = httpRequest("GET", url, headers=headers, params=api_count_params) 
     response_data = api_count_response.json()
     total_number = response_data.get("meta", {}).get("totalNumber", 0)
     api_calls = math.ceil(total_number / page_size)
 
     return api_calls
 
-def apiCall(page_size,skip_param,api_url,api_headers,type):
+def apiCall(page_size,skip_param,api_url,api_headers,type,api_select=None):
     ''' Makes an API call to ADP endpoints
 
     Args:   page_size_url (int):    Maximum number of records returned in a single API call
@@ -443,6 +1386,7 @@ def apiCall(page_size,skip_param,api_url,api_headers,type):
             api_url (str):          URL for the endpoint in use
             api_headers (None):     Contains header values for API call - Usually contains bearer token and accepted content type
             type (str):             filters staff by active, leave or terminated        
+            api_select (dict):      $select projection from adpProjection - Nullable
     
     Return: api_response (list):    Raw reponse data from API call
     '''
@@ -453,11 +1397,47 @@ def apiCall(page_size,skip_param,api_url,api_headers,type):
     "$skip": skip_param
     }
 
-    api_response = requests.get(api_url,cert=(certfile, keyfile), headers = api_headers, params = api_params)
-    time.sleep(0.6)   
+    api_response = requestWithProjection(api_url, api_headers, api_params, api_select)
 
     return api_response    
 
+def projectionParams(fields, prefix=""):
+    ''' Builds the $select for a field projection
+
+    Args:   fields (list): Fields the run type reads - Nullable
+            prefix (str): Path prepended to every field (ADP nests workers under "workers/")
+
+    Return: api_select (dict): {"$select": ...}, or None when exporting for debug so the raw fields are kept
+    '''
+    if not fields or data_export:
+        return None
+    return {"$select": ",".join(prefix + field for field in fields)}
+
+def adpProjection(run_type):
+    '''Returns the ADP workers projection for a run type, or None if $select is not enabled for ADP'''
+    if not adp_select_supported:
+        return None
+    return projectionParams(adp_worker_fields.get(run_type), "workers/")
+
+def requestWithProjection(api_url, api_headers, api_params, api_select):
+    ''' GET with an optional $select. If the endpoint rejects the projection (a 400 whose error mentions
+        $select) the call is repeated without it, and the endpoint is remembered so later calls skip the
+        projection. Any other 400 is returned to the caller.
+
+    Return: api_response (requests.Response)
+    '''
+    endpoint = api_url.split("?")[0]
+
+    if api_select and endpoint not in select_rejected_urls:
+        api_response = httpRequest("GET", api_url, headers = api_headers, params = {**api_params, **api_select})
+        if api_response.status_code != 400 or "select" not in api_response.text.lower():
+            return api_response
+
+        print(f"            $select rejected by {endpoint}, downloading all fields")
+        select_rejected_urls.add(endpoint)
+
+    return httpRequest("GET", api_url, headers = api_headers, params = api_params)
+
 def apiCountCascade(api_response,page_size):
     ''' Finds the necessary number of pages for a set of data using record count and page size
         Used once at the start of the api_call
@@ -489,8 +1469,12 @@ def apiCallCascade(cascade_token,api_url,api_params=None,api_data=None):
     'Authorization': f'Bearer {cascade_token}',
     }
 
-    api_response = requests.get(api_url, headers = cascade_api_headers, params = api_params, json=api_data)
-    time.sleep(0.6)   
+    if api_params and "$select" in api_params:
+        api_params = dict(api_params)
+        api_select = {"$select": api_params.pop("$select")}
+        return requestWithProjection(api_url, cascade_api_headers, api_params, api_select)
+
+    api_response = httpRequest("GET", api_url, headers = cascade_api_headers, params = api_params, json=api_data)
    
     return api_response
 
@@ -511,11 +1495,180 @@ def apiCallEvents(page_size,skip_param,api_url,api_headers):
     "$skip": skip_param
     }
 
-    api_response = requests.get(api_url,cert=(certfile, keyfile), headers = api_headers, params = api_params)
-    time.sleep(0.6)   
+    api_response = httpRequest("GET", api_url, headers = api_headers, params = api_params)
 
     return api_response    
 
+def fetchPages(page_keys, fetch_page, max_workers):
+    ''' Downloads a set of pages concurrently, keeping the order of page_keys.
+        Pages that fail are fetched again, up to page_fetch_attempts passes.
+
+    Args:   page_keys (list):       One hashable key per page, e.g. (status, page number)
+            fetch_page (function):  Takes a key and returns the records for that page, or None if the call failed
+            max_workers (int):      Maximum number of pages in flight at once
+
+    Return: pages (list):           Records for each page, in the same order as page_keys
+    '''
+
+    def safeFetch(key):
+        try:
+            return fetch_page(key)
+        except (requests.RequestException, ValueError) as e:
+            print(f"            Page {key} failed: {e}")
+            return None
+
+    pages = {}
+    pending = list(page_keys)
+
+    for attempt in range(page_fetch_attempts):
+        if not pending:
+            break
+
+        with ThreadPoolExecutor(max_workers=max(1, max_workers)) as executor:
+            results = list(executor.map(safeFetch, pending))
+
+        failed = []
+        for key, records in zip(pending, results):
+            if records is None:
+                failed.append(key)
+            else:
+                pages[key] = records
+
+        if failed and attempt < page_fetch_attempts - 1:
+            print(f"            {len(failed)} page(s) failed, fetching again")
+        pending = failed
+
+    if pending:
+        raise RuntimeError(f"Failed to download {len(pending)} page(s) after {page_fetch_attempts} attempts: {pending}")
+
+    return [pages[key] for key in page_keys]
+
+def getCascadeCollection(api_url,page_size,api_params=None):
+    ''' Downloads every record in a Cascade collection.
+        The first page also carries @odata.count, the rest of the pages are then fetched in parallel.
+
+    Args:   api_url (str):          URL for the collection
+            page_size (int):        Maximum number of records returned in a single API call
+            api_params (dict):      Extra query parameters such as $filter - Nullable
+
+    Return: records (list):         All records in the collection, in page order
+    '''
+
+    base_params = dict(api_params or {})
+    if "count=true" not in api_url:
+        base_params["$count"] = "true"
+    if "$orderby" not in api_url:
+        base_params.setdefault("$orderby", "Id")                                # $skip pages need a stable order
+
+    def fetchCascadePage(i):
+        page_params = {**base_params, "$top": page_size, "$skip": i * page_size}
+        api_response = apiCallCascade(cascade_token,api_url,page_params)
+
+        if api_response.status_code != 200:
+            print(f"            Page {i} of {api_url} returned {api_response.status_code}")
+            return None
+        return api_response
+
+    if cascade_page_workers <= 1:
+        return walkCascadeCollection(api_url,page_size,api_params)
+
+    first_response = fetchPages([0], fetchCascadePage, 1)[0]
+    records = first_response.json()['value']
+
+    if '@odata.count' not in first_response.json():                            # Endpoint ignores $count - walk the rest until a short page
+        if len(records) == page_size:
+            records.extend(walkCascadeCollection(api_url,page_size,api_params,skip_param=page_size))
+        return records
+
+    api_calls = apiCountCascade(first_response,page_size)
+
+    remaining = fetchPages(list(range(1, api_calls)), fetchCascadePage, cascade_page_workers)
+    for api_response in remaining:
+        records.extend(api_response.json()['value'])
+
+    return records
+
+def walkCascadeCollection(api_url,page_size,api_params=None,skip_param=0):
+    ''' Downloads a Cascade collection one page after another.
+        Stops once @odata.count records have been seen - or, when the endpoint sends no count, on a short page -
+        so no separate count call is needed.
+
+    Args:   api_url (str):          URL for the collection
+            page_size (int):        Maximum number of records returned in a single API call
+            api_params (dict):      Extra query parameters such as $filter - Nullable
+            skip_param (int):       Record offset to start from
+
+    Return: records (list):         Every record from skip_param onwards, in page order
+    '''
+
+    base_params = dict(api_params or {})
+    if "count=true" not in api_url:
+        base_params["$count"] = "true"
+    if "$orderby" not in api_url:
+        base_params.setdefault("$orderby", "Id")                                # $skip pages need a stable order
+
+    def fetchCascadePage(skip):
+        api_response = apiCallCascade(cascade_token,api_url,{**base_params, "$top": page_size, "$skip": skip})
+
+        if api_response.status_code != 200:
+            print(f"            Records from {skip} of {api_url} returned {api_response.status_code}")
+            return None
+        return api_response.json()
+
+    records = []
+    total_number = None
+
+    while True:
+        data = fetchPages([skip_param], fetchCascadePage, 1)[0]
+        page = data.get('value', [])
+        records.extend(page)
+
+        skip_param += len(page)
+        total_number = data.get('@odata.count', total_number)
+
+        if not page:
+            return records
+        if total_number is not None:
+            if skip_param >= total_number:
+                return records
+        elif len(page) < page_size:
+            return records
+
+def walkAdpWorkers(status,page_size,api_headers,api_select=None):
+    ''' Downloads ADP workers for one status one page after another, stopping on a short or empty page.
+        Skips the count=true request that the paged download needs.
+
+    Args:   status (str):           active, leave or terminated
+            page_size (int):        Maximum number of records returned in a single API call
+            api_headers (dict):     Contains header values for API call - Usually contains bearer token and accepted content type
+            api_select (dict):      $select projection from adpProjection - Nullable
+
+    Return: workers (list):         All workers with the status (excluded workers are dropped)
+    '''
+
+    def fetchAdpPage(skip):
+        api_response = apiCall(page_size,skip,adp_workers,api_headers,statusType(status),api_select)
+
+        if api_response.status_code == 204:                                     # ADP returns no content once past the last record
+            return []
+        if api_response.status_code != 200:
+            print(f"            Records from {skip} of {status} returned {api_response.status_code}")
+            return None
+        return api_response.json().get('workers', [])
+
+    workers = []
+    skip_param = 0
+
+    while True:
+        page = fetchPages([skip_param], fetchAdpPage, 1)[0]
+
+        workers.extend(worker for worker in page if worker.get('workerID', {}).get('idValue') not in strings_to_exclude)
+
+        skip_param += len(page)
+
+        if len(page) < page_size:
+            return workers
+
 # Global Data Calls
 
 def statusType(status):
@@ -528,9 +1681,11 @@ def statusType(status):
     }
     return status_map.get(status)
 
-def getWorkersAdp():
+def getWorkersAdp(run_type=None):
     ''' Downloads the current data from ADP workers
     
+        Args:   run_type (int): Limits the download to the fields that run type reads - Nullable for every field
+
         Return: list of dictionary for all staff split by worker category
     '''
     
@@ -539,110 +1694,126 @@ def getWorkersAdp():
     adp_terminated = []
     adp_leave = []
 
-    for status in ["active","leave","terminated"]:
-        print (f"       Downloading ADP Staff with the status - {status}")
-               
-        type = statusType (status)
-        
-        page_size = 100
-        
-        api_headers = {
-            'Authorization': f'Bearer {access_token}',
-            'Accept':"application/json;masked=false"
-            }
-        
-        api_calls = apiCountAdp(page_size,adp_workers,api_headers,type)
-        for i in range(api_calls):
-            skip_param = i * page_size
-
-            api_response = apiCall(page_size,skip_param,adp_workers,api_headers,type)
-
-            if api_response.status_code == 200:
-                json_data = api_response.json()
-                json_data = json_data['workers']
-           
-                filtered_data = [
-                    worker for worker in json_data 
-                    if worker.get('workerID', {}).get('idValue') not in strings_to_exclude
-                ]
-                    
-                globals()[f"adp_{status}"].extend(filtered_data)
-            else:
-                continue
+    statuses = ["active","leave","terminated"]
+    page_size = 100
+    
+    api_headers = {
+        'Authorization': f'Bearer {access_token}',
+        'Accept':"application/json;masked=false"
+        }
+    api_select = adpProjection(run_type)
+
+    if adp_download_mode == "walk":
+        print (f"       Downloading ADP Staff page by page with the statuses - {', '.join(statuses)}")
+        with ThreadPoolExecutor(max_workers=len(statuses)) as executor:
+            walked = list(executor.map(lambda status: walkAdpWorkers(status,page_size,api_headers,api_select), statuses))
+
+        for status, workers in zip(statuses, walked):
+            globals()[f"adp_{status}"].extend(workers)
+            exportData("002 - Security and Global", f"001 - ADP (Data Out - {status}).json", globals()[f"adp_{status}"])    
+
+        return adp_active, adp_leave, adp_terminated
+
+    with ThreadPoolExecutor(max_workers=len(statuses)) as executor:
+        counts = list(executor.map(lambda status: apiCountAdp(page_size,adp_workers,api_headers,statusType(status)), statuses))
+
+    page_keys = []
+    for status, api_calls in zip(statuses, counts):
+        print (f"       Downloading ADP Staff with the status - {status} ({api_calls} pages)")
+        page_keys.extend((status, i) for i in range(api_calls))
+
+    def fetchAdpPage(key):
+        status, i = key
+        skip_param = i * page_size
+
+        api_response = apiCall(page_size,skip_param,adp_workers,api_headers,statusType(status),api_select)
+
+        if api_response.status_code == 204:                                     # ADP returns no content once past the last record
+            return []
+        if api_response.status_code != 200:
+            print(f"            Page {i} of {status} returned {api_response.status_code}")
+            return None
+
+        json_data = api_response.json()
+        json_data = json_data['workers']
+
+        return [
+            worker for worker in json_data 
+            if worker.get('workerID', {}).get('idValue') not in strings_to_exclude
+        ]
+
+    pages = fetchPages(page_keys, fetchAdpPage, adp_page_workers)
+
+    for (status, _), filtered_data in zip(page_keys, pages):
+        globals()[f"adp_{status}"].extend(filtered_data)
 
+    for status in statuses:
         exportData("002 - Security and Global", f"001 - ADP (Data Out - {status}).json", globals()[f"adp_{status}"])    
 
     return adp_active, adp_leave, adp_terminated
 
-def getWorkersCascade():
+def getWorkersCascade(run_type=None):
     ''' Downloads the current data from Cascade workers
     
+        Args:   run_type (int): Limits the download to the fields that run type reads - Nullable for every field
+
         Return: list of dictionary for all staff currently on roll
     '''
 
     time_now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
     print ("    Retrieving current Personal Data from Cascade HR (" + time_now + ")")
-    global cascade_responses
-
-    cascade_responses = []
+    global cascade_responses, cascade_index
 
     page_size = 200
 
-    api_response = apiCallCascade(cascade_token,cascade_workers,None)
-    api_calls = apiCountCascade(api_response,page_size)                
-
-    for i in range(api_calls):
-            skip_param = i * page_size
-            api_params = {
-                "$top": page_size,
-                "$skip": skip_param
-            } 
-            
-            api_response = apiCallCascade(cascade_token,cascade_workers,api_params)
-
-            if api_response.status_code == 200:
-                json_data = api_response.json()
-                json_data = json_data['value']
-                cascade_responses.extend(json_data)    
+    cascade_responses = getCascadeCollection(cascade_workers,page_size,projectionParams(cascade_worker_fields.get(run_type)))
 
     cascade_responses = [record for record in cascade_responses if record.get('DisplayId') is not None]
+    cascade_index = indexCascadeWorkers(cascade_responses)
 
     exportData("002 - Security and Global", "001 - Cascade Raw Out.json", cascade_responses)    
 
     return cascade_responses
 
-def getHierarchyNodes(hierarchy_ids,url,headers):
-    ''' Generates all child nodes for a given Hierarchy Node
+def getHierarchyNodes(hierarchy_ids,url):
+    ''' Generates all child nodes for one level of the hierarchy.
+        Parents are combined into OR filters of hierarchy_filter_chunk nodes and the chunks are fetched in parallel.
 
-    Args:   hierarchy_ids (str):        Given hierarchy node
+    Args:   hierarchy_ids (list):       Hierarchy nodes on the current level
+            url (str):                  Hierarchy endpoint
 
     Return: hierarchy_nodes (list):     Full hierarchy nodes for all child nodes of Arg
             hierarchy_id_nodes (list):  Id's for all the nodes above.
     '''  
 
-    hierarchy_nodes = []
-    hierarchy_id_nodes = []
+    page_size = 200
+    chunks = [hierarchy_ids[i:i + hierarchy_filter_chunk] for i in range(0, len(hierarchy_ids), hierarchy_filter_chunk)]
 
-    for h_id in hierarchy_ids:
+    def fetchChildren(chunk):
+        parent_filter = " or ".join(f"parentId eq '{h_id}'" for h_id in chunk)
         params = {
-            "$filter": f"parentId eq '{h_id}' and disabled eq false"
+            "$filter": f"({parent_filter}) and disabled eq false"
         }
+        return getCascadeCollection(url,page_size,params)
 
-        for attempt in range(2):  # Attempt up to 2 times
-            response = requests.get(url, params=params, headers=headers)
-            time.sleep(0.6)  # Always sleep between requests
-
-            if response.status_code == 200:
-                data = response.json()
-                for record in data.get('value', []):
-                    hierarchy_nodes.append(record)
-                    hierarchy_id_nodes.append(record['Id'])
-                break  # Exit retry loop on success
-            elif attempt == 0:
-                print(f"            Request failed for parentId {h_id}, retrying in 1 second...")
-                time.sleep(3)
-            else:
-                print(f"            Failed to retrieve data for parentId {h_id}: {response.status_code}")
+    with ThreadPoolExecutor(max_workers=max(1, cascade_page_workers)) as executor:
+        results = list(executor.map(fetchChildren, chunks))
+
+    children_map = defaultdict(list)
+    for records in results:
+        for record in records:
+            children_map[record.get('ParentId')].append(record)
+
+    hierarchy_nodes = []
+    hierarchy_id_nodes = []
+
+    parent_ids = set(hierarchy_ids)
+    ordered_parents = list(hierarchy_ids) + [p for p in children_map if p not in parent_ids]
+
+    for h_id in ordered_parents:                                                # Keeps the parent by parent order of the old per-node calls
+        for record in children_map.get(h_id, []):
+            hierarchy_nodes.append(record)
+            hierarchy_id_nodes.append(record['Id'])
 
     return hierarchy_nodes, hierarchy_id_nodes
 
@@ -669,7 +1840,7 @@ def getHierarchyList(country):
         "$filter": f"Id eq '{H_top_level}'"
     }
 
-    response = requests.get(api_url, params=initial_params, headers=api_headers)
+    response = httpRequest("GET", api_url, params=initial_params, headers=api_headers)
     if response.status_code == 200:
         data = response.json()
         hierarchy_nodes = []
@@ -680,9 +1851,9 @@ def getHierarchyList(country):
             hierarchy_nodes.append(record)
             hierarchy_id_nodes.append(record['Id'])
 
-        # Recursive call to get all descendant nodes
+        # One batched call per level of the tree
         while hierarchy_id_nodes:
-            new_nodes, new_id_nodes = getHierarchyNodes(hierarchy_id_nodes,api_url,api_headers)
+            new_nodes, new_id_nodes = getHierarchyNodes(hierarchy_id_nodes,api_url)
             hierarchy_nodes.extend(new_nodes)
             hierarchy_id_nodes = new_id_nodes
     else:
@@ -708,6 +1879,23 @@ def findActiveJobPosition(worker):
             continue
     return active_job_position
 
+def indexCascadeWorkers(cascade_responses):
+    ''' Builds the lookups over the Cascade worker snapshot. Built once per download and shared by
+        findCascadeIdAndContService, findName and makeApiRequest.
+
+    Args:   cascade_responses (list): All raw personal data from Cascade api
+
+    Return: index (dict): NationalInsuranceNumber (as str), Id and DisplayId -> first matching worker
+    '''
+    index = {"NationalInsuranceNumber": {}, "Id": {}, "DisplayId": {}}
+
+    for entry in cascade_responses:
+        index["NationalInsuranceNumber"].setdefault(str(entry.get("NationalInsuranceNumber")), entry)
+        index["Id"].setdefault(entry.get("Id"), entry)
+        index["DisplayId"].setdefault(entry.get("DisplayId"), entry)
+
+    return index
+
 def findCascadeIdAndContService(ADP_identifier):
     ''' Matches cascade information for a given ADP AOID
 
@@ -719,35 +1907,69 @@ def findCascadeIdAndContService(ADP_identifier):
     '''
 
     CascadeID = Cascade_full = contServiceCascade = None
-    for entry in cascade_responses:
-        if str(entry.get("NationalInsuranceNumber")) == str(ADP_identifier):
+    entry = cascade_index["NationalInsuranceNumber"].get(str(ADP_identifier))
 
-            CascadeID = entry.get("DisplayId")
+    if entry is not None:
+        CascadeID = entry.get("DisplayId")
 
-            if CascadeID is None:
-                Cascade_full = None
-            else:
-                Cascade_full = entry.get("Id")
-                contServiceCascade = entry.get("ContinuousServiceDate")
-            break 
+        if CascadeID is None:
+            Cascade_full = None
+        else:
+            Cascade_full = entry.get("Id")
+            contServiceCascade = entry.get("ContinuousServiceDate")
     return CascadeID,Cascade_full,contServiceCascade
 
-def findHierarchyId(job_code,job_name,hierarchy_library): 
+def compileHierarchyMap(hierarchy_library):
+    ''' Builds the hierarchy lookup tables once per run
+
+    Keys are compared as str() values, exactly as the old linear scan compared them, and on duplicate
+    rows the first one is kept. Code-only and name-only fallbacks are only built when switched on, and
+    only for codes/names that point at a single hierarchy node so a fallback never guesses.
+
+    Args:   hierarchy_library (list): all hierarchys for target country
+
+    Return: hierarchy_map (dict): exact/code/name lookup tables plus an "unmapped" set filled by findHierarchyId
+    '''
+    exact = {}
+    by_code = {}
+    by_name = {}
+
+    for item in hierarchy_library:
+        cascade_id = str(item["CascadeId"])
+        code = str(item["Job Code"])
+        name = str(item["Job Name"])
+
+        exact.setdefault((code, name), cascade_id)
+        by_code.setdefault(code, set()).add(cascade_id)
+        by_name.setdefault(name, set()).add(cascade_id)
+
+    hierarchy_map = {
+        "exact": exact,
+        "code": {k: next(iter(v)) for k, v in by_code.items() if len(v) == 1} if hierarchy_fallback_code else {},
+        "name": {k: next(iter(v)) for k, v in by_name.items() if len(v) == 1} if hierarchy_fallback_name else {},
+        "unmapped": set(),
+    }
+    return hierarchy_map
+
+def findHierarchyId(job_code,job_name,hierarchy_map): 
     ''' Converts job code and name to hierarchy
     
     Args:   job_code (str): job code from ADP
             job_name (str): job name from ADP
-            hierarchy_library (list): all hierarchys for target country
+            hierarchy_map (dict): compiled hierarchy tables from compileHierarchyMap
 
     Return: hierarchy (str): Individual Hierarchy Id for given worker
     '''    
-    hierarchy = None 
-
-    # First pass: try exact match (code + name) 
-    for item in hierarchy_library: 
-        if str(item["Job Code"]) == str(job_code) and str(item["Job Name"]) == str(job_name): 
-            hierarchy = str(item["CascadeId"])
-            break 
+    code = str(job_code)
+    name = str(job_name)
+
+    hierarchy = hierarchy_map["exact"].get((code, name))
+    if hierarchy is None:
+        hierarchy = hierarchy_map["code"].get(code)
+    if hierarchy is None:
+        hierarchy = hierarchy_map["name"].get(name)
+    if hierarchy is None:
+        hierarchy_map["unmapped"].add((code, name))
                    
     return hierarchy
 
@@ -789,6 +2011,15 @@ def findJobNamesAndCodes(country, adp_responses):
 
     return unique_job_records
 
+def openHierarchySpreadsheet():
+    '''Opens the hierarchy gsheet once and reuses it for every upload/download'''
+
+    global hierarchy_spreadsheet
+    if hierarchy_spreadsheet is None:
+        spreadsheet_id = getSecret("hierarchy_gsheet_id")
+        hierarchy_spreadsheet = getGcpClient("gspread").open_by_key(spreadsheet_id)
+    return hierarchy_spreadsheet
+
 def uploadToGsheets(sheet_name, range, start, data):
     ''' Uploads data to gsheets.
 
@@ -800,9 +2031,7 @@ def uploadToGsheets(sheet_name, range, start, data):
     Return: None    
     '''
 
-    spreadsheet_id = getSecret("hierarchy_gsheet_id")
-    sh = gc.open_by_key(spreadsheet_id)
-    worksheet = sh.worksheet(sheet_name)
+    worksheet = openHierarchySpreadsheet().worksheet(sheet_name)
     worksheet.batch_clear([range])
     worksheet.update(range_name=start, values=data)
 
@@ -815,9 +2044,7 @@ def downloadFromGsheets(sheet_name, range):
     Return:  data range (dict)           
     '''
 
-    spreadsheet_id = getSecret("hierarchy_gsheet_id")
-    sh = gc.open_by_key(spreadsheet_id)
-    worksheet = sh.worksheet(sheet_name)
+    worksheet = openHierarchySpreadsheet().worksheet(sheet_name)
     data = worksheet.get(range)
 
     if not data or len(data) < 2:
@@ -866,6 +2093,62 @@ def findCascadeHierarchylist(nodes):
 
     uploadToGsheets(f"Hierarchy ({c})", "E:G", "E1", results)
 
+class IDLibrary:
+    ''' ID library held as compact rows with a hash index on each identifier.
+        Iterating yields the records as dicts, so it can still be exported or uploaded like the old list.
+    '''
+
+    fields = ("AOID", "CascadeId", "Cascade_full", "ADP_number", "ADP_line_manager", "Job_position",
+              "Job Code", "Job Name", "Hierarchy", "Cascade Start", "ADP Start", "contServiceDate")
+    indexed_fields = ("AOID", "ADP_number", "CascadeId", "Cascade_full")
+    multi_indexed_fields = ("AOID",)                                    # AOIDs repeat - findLineManager kept the last match, absences sync every one
+
+    __slots__ = ("rows", "indexes", "multi_indexes")
+
+    def __init__(self, records=()):
+        self.rows = []
+        self.indexes = {field: {} for field in self.indexed_fields}
+        self.multi_indexes = {field: {} for field in self.multi_indexed_fields}
+        for record in records:
+            self.append(record)
+
+    def append(self, record):
+        '''Adds a record - indexes keep the first record for an identifier, multi_indexes every record'''
+        position = len(self.rows)
+        self.rows.append(tuple(record.get(field) for field in self.fields))
+        for field, index in self.indexes.items():
+            index.setdefault(record.get(field), position)
+        for field, index in self.multi_indexes.items():
+            index.setdefault(record.get(field), []).append(position)
+
+    def __len__(self):
+        return len(self.rows)
+
+    def __iter__(self):
+        for row in self.rows:
+            yield dict(zip(self.fields, row))
+
+    def __getitem__(self, position):
+        return dict(zip(self.fields, self.rows[position]))
+
+    def position(self, field, value):
+        '''Returns the row position of the first record with field == value - None if there is no match'''
+        return self.indexes[field].get(value)
+
+    def find(self, field, value):
+        '''Returns the first record with field == value - None if there is no match'''
+        position = self.indexes[field].get(value)
+        return None if position is None else self[position]
+
+    def positions(self, field, value):
+        '''Returns the row positions of every record with field == value (field must be in multi_indexed_fields)'''
+        return self.multi_indexes[field].get(value, [])
+
+    def findLast(self, field, value):
+        '''Returns the last record with field == value (field must be in multi_indexed_fields) - None if there is no match'''
+        positions = self.positions(field, value)
+        return self[positions[-1]] if positions else None
+
 def export_to_bq(credentials, project_id: str, data: list[dict],country) -> None:
     ''' Uploads the ID_library to bigQuery
 
@@ -874,7 +2157,7 @@ def export_to_bq(credentials, project_id: str, data: list[dict],country) -> None
             Data (list): All data for ID Library
             country(str): usa or can - used to identify target table
     '''
-    client = bigquery.Client(project=project_id, credentials=credentials)
+    client = getGcpClient("bigquery", credentials, project_id)
 
     full_table_ref = f"{project_id}.library.library_{country}"
 
@@ -913,10 +2196,10 @@ def import_from_bq(credentials, project_id: str, country: str) -> list[dict]:
             projectId (str): gcp project id
             country(str): usa or can - used to identify target table
     
-    Return: Data (list): Id Library for use in event-driven absences
+    Return: Data (IDLibrary): Id Library for use in event-driven absences
     '''
 
-    client = bigquery.Client(project=project_id, credentials=credentials)
+    client = getGcpClient("bigquery", credentials, project_id)
 
     full_table_ref = f"{project_id}.library.library_{country}"
 
@@ -944,7 +2227,7 @@ def import_from_bq(credentials, project_id: str, country: str) -> list[dict]:
     
     exportData("002 - Security and Global","003 - ID_library.json", data)
 
-    return data
+    return IDLibrary(data)
 
 def IDGenerator(country,adp_responses):
     ''' Creates an ID Library for staff for use when synchronising Data
@@ -952,14 +2235,15 @@ def IDGenerator(country,adp_responses):
     Args:   Country (str): usa or can
             adp_responses (list): all raw adp responses from personal data api
     
-    Return: ID_library (list[dict]): ID Library for USA/CAN staff.
+    Return: ID_library (IDLibrary): ID Library for USA/CAN staff.
     '''
 
     time_now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
     print ("    Creating an ID library (" + time_now + ")")
    
     hierarchy_library = downloadFromGsheets(f"Hierarchy ({c})","K:O")
-    ID_library = []
+    hierarchy_map = compileHierarchyMap(hierarchy_library)
+    ID_library = IDLibrary()
 
     exportData("002 - Security and Global",f"002 - {country} Hierarchy.json", hierarchy_library)    
 
@@ -997,7 +2281,7 @@ def IDGenerator(country,adp_responses):
 
         CascadeID, Cascade_full, contServiceCascade = findCascadeIdAndContService(ADP_identifier)
 
-        hierarchy_id = findHierarchyId(job_code, job_name, hierarchy_library)
+        hierarchy_id = findHierarchyId(job_code, job_name, hierarchy_map)
 
         if CascadeID is None:
             date = formatted_date
@@ -1024,7 +2308,12 @@ def IDGenerator(country,adp_responses):
         
         ID_library.append(transformed_record)
 
-    exportData("002 - Security and Global","003 - ID_library.json", ID_library)
+    exportData("002 - Security and Global","003 - ID_library.json", list(ID_library))
+
+    unmapped = [{"Job Code": code, "Job Name": name} for code, name in sorted(hierarchy_map["unmapped"], key=str)]
+    if unmapped:
+        print(f"        {len(unmapped)} job code/name pairs have no hierarchy mapping")
+    exportData("002 - Security and Global",f"002a - {country} Unmapped Hierarchy.json", unmapped)
 
     export_to_bq(creds,project_Id,ID_library,c)
     
@@ -1043,28 +2332,9 @@ def cascadeAbsenceReasons():
     print ("    Retrieving Absence Reasons Data from Cascade HR (" + time_now + ")")
     global cascade_absence_reasons
 
-    cascade_absence_reasons = []
-
     page_size = 200
 
-    api_response = apiCallCascade(cascade_token,cascade_absence_reasons_url,None)
-
-    api_calls = apiCountCascade(api_response,page_size)                
-
-    for i in range(api_calls):
-            skip_param = i * page_size
-            api_params = {
-                "$top": page_size,
-                "$skip": skip_param
-            } 
-            
-            api_response = apiCallCascade(cascade_token,cascade_absence_reasons_url,api_params)
-
-            if api_response.status_code == 200:
-                json_data = api_response.json()
-                json_data = json_data['value']
-                cascade_absence_reasons.extend(json_data)    
-
+    cascade_absence_reasons = getCascadeCollection(cascade_absence_reasons_url,page_size)
 
     exportData("002 - Security and Global", "001 - Cascade Absences Raw.json", cascade_absence_reasons)    
 
@@ -1111,14 +2381,14 @@ def findAbsenceHierarchy(nodes, prefixes):
 def createCascadeidUpdateList(ID_library, cascade, adp):
     '''Creates a list of ADP AOID that do not have a cascade ID in the id library
 
-    Args:   ID_library (list): List of all staff
+    Args:   ID_library (IDLibrary): List of all staff
             cascade (str): Cascade Id
             adp (str): AOID for given member of staff
     '''
-    cascade_exists_in_library = any(record["CascadeId"] == cascade for record in ID_library)
+    cascade_exists_in_library = ID_library.position("CascadeId", cascade) is not None
 
     if not cascade_exists_in_library:
-        match = next((record for record in ID_library if record["ADP_number"] == adp), None)
+        match = ID_library.find("ADP_number", adp)
 
         if match:
             return {
@@ -1130,7 +2400,7 @@ def whatsInAdp(adp_responses, ID_library,c):
     '''Creates a list of staff who need a cascade ID adding
 
     Args:   adp_responses (list): All staff for a given country
-            ID_library (list): All staff Id
+            ID_library (IDLibrary): All staff Id
             c (str): usa or can
 
     Return: ID_reponses (list): All ID's that need adding to ADP
@@ -1162,21 +2432,72 @@ def whatsInAdp(adp_responses, ID_library,c):
 
     return ID_responses
 
+def loadWritebackLedger(country):
+    ''' Downloads the ledger of Cascade IDs already written back to ADP.
+        Only entries from the last cascade_id_ledger_hours are kept - the ledger lets a rerun skip what the
+        failed run already pushed, but whatsInAdp stays the source of truth for what is missing.
+
+    Args:   country (str): usa or can
+
+    Return: ledger (dict): AOID -> {"Cascade", "uploaded"} - empty when the ledger is off or missing
+            generation (int): GCS generation the ledger was read at - 0 when there is no ledger yet
+    '''
+    if not cascade_id_ledger:
+        return {}, 0
+
+    bucket = storage_client.bucket(workbook_bucket)
+    name = cascade_id_ledger.format(country=country)
+    blob = bucket.get_blob(name)
+    if blob is None:
+        return {}, 0
+
+    generation = blob.generation
+    ledger = json.loads(bucket.blob(name, generation=generation).download_as_text())
+
+    cutoff = (datetime.now() - timedelta(hours=cascade_id_ledger_hours)).strftime("%Y-%m-%d %H:%M:%S")
+    return {aoid: entry for aoid, entry in ledger.items() if entry.get("uploaded", "") >= cutoff}, generation
+
+def saveWritebackLedger(country, ledger, generation):
+    ''' Uploads the write-back ledger so a rerun only pushes the writes that failed.
+        The upload only succeeds if the ledger is still at the generation it was read at, so two runs can't
+        overwrite each other's entries.
+
+    Args:   country (str): usa or can
+            ledger (dict): AOID -> {"Cascade", "uploaded"}
+            generation (int): generation from loadWritebackLedger
+    '''
+    if not cascade_id_ledger:
+        return
+
+    blob = storage_client.bucket(workbook_bucket).blob(cascade_id_ledger.format(country=country))
+    try:
+        blob.upload_from_string(json.dumps(ledger, separators=(",", ":")), content_type="application/json", if_generation_match=generation)
+    except PreconditionFailed:
+        print ("            Write-back ledger was changed by another run, not saved")
+
 def uploadCascadeidsToAdp(CascadeId_to_upload,country):
-    '''Adds cascade ID to ADP
+    '''Adds cascade ID to ADP. The events are posted concurrently over the ADP mTLS pool, and each AOID that
+       succeeds is recorded in the bucket ledger so a rerun within cascade_id_ledger_hours skips it and only
+       pushes the failures.
     
     Args: CascadeId_to_upload (list): All Id's that need adding to ADP
           country (str): usa or can
 
-    Return: None
+    Return: outcomes (list): Per-AOID write outcomes from runWrites
     
     '''
     ct_POST_cascade_id = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
     print ("        Updating Cascade ID's on WFN (" + ct_POST_cascade_id + ")")
 
     api_url = 'https://api.adp.com/events/hr/v1/worker.person.custom-field.string.change'
-    
-    for entry in CascadeId_to_upload:
+
+    ledger, generation = loadWritebackLedger(country)
+    pending = [entry for entry in CascadeId_to_upload if ledger.get(entry['AOID'], {}).get("Cascade") != entry['Cascade']]
+    if len(pending) < len(CascadeId_to_upload):
+        print ("            " + f'{len(CascadeId_to_upload) - len(pending)} already written back on an earlier run')
+
+    operations = []
+    for entry in pending:
         AOID = entry['AOID']
         if country == "usa":
             ItemID = '9200019333951_24129'         
@@ -1216,18 +2537,31 @@ def uploadCascadeidsToAdp(CascadeId_to_upload,country):
                 ]
             }
 
-        data_to_write = json.dumps(schema, indent=4)
+        data_to_write = json.dumps(schema, separators=(",", ":"))
 
         api_headers = {
             'Authorization': f'Bearer {access_token}',
             'Content-Type': "application/json",
         }            
-        req = requests.post(api_url, cert=(certfile, keyfile), verify=True, headers=api_headers, data=data_to_write)
-        
-        if req.status_code ==200:
+        operations.append(writeOperation(AOID, "POST", api_url, "adp_custom_field", (200,), headers=api_headers, data=data_to_write))
+
+    outcomes = runWrites(operations)
+
+    uploaded = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    for entry, outcome in zip(pending, outcomes):
+        cascadeId = entry['Cascade']
+        if outcome["ok"]:
+            ledger[entry['AOID']] = {"Cascade": cascadeId, "uploaded": uploaded}
             print ("        "+f'Data uploaded for CascadeId: {cascadeId}')
         else:
-            print("        "+f'Response Code: {req.status_code}')
+            print("        "+f'Response Code: {outcome["status"] or outcome["error"]}')
+
+    if any(outcome["ok"] for outcome in outcomes):
+        saveWritebackLedger(country, ledger, generation)
+
+    exportData("006 - CascadeId to ADP","004 - Write-back report.json", writeReport(outcomes))
+
+    return outcomes
 #---------------------------------------- Top Level Function
 def runType1():
     time_now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
@@ -1239,8 +2573,7 @@ def runType1():
 # Delete/Update Absences (run-type-2)
 #---------------------------------------- Top Level Function               
 def createAbsencesReasons():
-    xlsx_in_memory = loadXlsxFromBucket("Hierarchy")
-    df = pd.read_excel(xlsx_in_memory, sheet_name=f"{c} Absences")
+    df = loadWorkbookSheets("Hierarchy")[f"{c} Absences"]
                           
     if c == "usa":
         absence_reasons = df.where(pd.notna(df), None).to_dict(orient='records')
@@ -1263,13 +2596,13 @@ def getCascadeId(CascadeId,ID_library):
     ''' Finds cascadeID and SOID for a display id
     
     Args:   CascadeId (str): Frontend ID for cascade
-            ID_library (list): Lookup table for ADP staff
+            ID_library (IDLibrary): Lookup table for ADP staff
 
     Return: Cascade_full (str): Cascade backend ID
             AOID: ADP internal id
     
     '''
-    match = next((record for record in ID_library if record["CascadeId"] == CascadeId), None)
+    match = ID_library.find("CascadeId", CascadeId)
 
     if match is None:
         raise ValueError(f"No record found for CascadeId: {CascadeId}")
@@ -1288,18 +2621,12 @@ def getAbsencesAdp(AOID):
         'Authorization': f'Bearer {access_token}',
     }
 
-    while True:
-        api_response = requests.get(api_url, cert=(certfile, keyfile), verify=True, headers=api_headers)
-        
-        if api_response.status_code == 429:
-            time.sleep(1)
-            continue
-        
-        break
+    api_response = httpRequest("GET", api_url, headers=api_headers)
     
     adp_response = api_response.json()
 
-    exportData("005 - Absences to Cascade","002 - ADP Raw absence response (Individual).json", adp_response)    
+    if data_export:
+        adp_absence_responses[AOID] = adp_response                         # Exported once by runType2
 
     return adp_response
 
@@ -1358,29 +2685,67 @@ def convertAdpAbsencesToCascadeFormat(adp_response, absence_reasons, Cascade_ful
 
     return filtered_records
 
-def cascadeAbsences(Cascade_full,absences_from):
+def cascadeAbsencesBulk(absences_from):
+    ''' Downloads every Cascade absence since absences_from in one paged query
+
+    The collection is not split by country, so the download is kept for the day and reused by the
+    other countries in the run.
+
+    Args:   absences_from (str): Given date to search from. Normally 90 days to match ADP default behaviour
+
+    Return: absences_by_employee (dict): EmployeeId -> raw Cascade absences for that employee
+    '''
+
+    cache_key = absences_from[:10]
+    if cache_key in absence_bulk_cache:
+        print ("        Reusing Cascade absences downloaded since " + absences_from[:10])
+        return absence_bulk_cache[cache_key]
+
+    time_now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    print ("        Downloading all Cascade absences since " + absences_from + " (" + time_now + ")")
+
+    page_size = 200
+    api_params = {
+        "$filter": "startDate ge "+absences_from,
+    }
+    cascade_absences = getCascadeCollection(cascade_absences_url,page_size,api_params)
+
+    absences_by_employee = defaultdict(list)
+    for entry in cascade_absences:
+        absences_by_employee[entry["EmployeeId"]].append(entry)
+
+    print (f"            {len(cascade_absences)} absences for {len(absences_by_employee)} staff")
+    absence_bulk_cache.clear()
+    absence_bulk_cache[cache_key] = absences_by_employee
+    return absences_by_employee
+
+def cascadeAbsences(Cascade_full,absences_from,absences_by_employee=None):
     ''' Finds all absences in the last x days from cascade
     
     Args:   Cascade_full (str): Backend cascade id
             absences_from (dt): Given date to search from. Normally 90 days to match ADP default behaviour
+            absences_by_employee (dict): Pre-grouped absences from cascadeAbsencesBulk - Nullable to ask Cascade for this employee
     
     Return: updated_json_data (list): All absences within the last x days
             absence_id_cascade (list): All IDs for the above absences.
     '''
 
-    cascade_responses = []
-    api_params = {
-        "$filter": "EmployeeId eq '"+Cascade_full+"' and startDate ge "+absences_from,             #add this to filter to the last 90 days
-    }
-    api_response = apiCallCascade(cascade_token,cascade_absences_url,api_params,None)
-    
-    if api_response.status_code == 200:
-        json_data = api_response.json()
-        cascade_responses.append(json_data)
+    if absences_by_employee is not None:
+        combined_data = absences_by_employee.get(Cascade_full, [])
     else:
-        print(f"Failed to retrieve data from API. Status code: {api_response.status_code}")
+        cascade_responses = []
+        api_params = {
+            "$filter": "EmployeeId eq '"+Cascade_full+"' and startDate ge "+absences_from,             #add this to filter to the last 90 days
+        }
+        api_response = apiCallCascade(cascade_token,cascade_absences_url,api_params,None)
+        
+        if api_response.status_code == 200:
+            json_data = api_response.json()
+            cascade_responses.append(json_data)
+        else:
+            print(f"Failed to retrieve data from API. Status code: {api_response.status_code}")
 
-    combined_data = [entry for response in cascade_responses for entry in response.get('value', [])]
+        combined_data = [entry for response in cascade_responses for entry in response.get('value', [])]
 
     updated_json_data = [
         {
@@ -1479,61 +2844,68 @@ def PostAbsences(new_records,Cascade_full):
     
     Args:   new_records (list): All absences to add
             cascade_full (str): specific id to add the absence to.    
+
+    Return: outcomes (list): Per-record write outcomes from runWrites
     '''
 
     output=[]
 
     if not new_records:
         print("                No records to add")
-    else:
-        for record in new_records:
+        return []
 
-            new_record = {
-                "EmployeeId": Cascade_full,
-                "AbsenceReasonId": record["AbsenceReasonId"],
-                "Narrative": None,
-                "StartDate": record["StartDate"],
-                "EndDate": record["EndDate"],
-            }
+    operations = []
+    for record in new_records:
 
-            params = {
-                "autoGenerateDaysBasedOnWorkingPattern": "true"
-            }
+        new_record = {
+            "EmployeeId": Cascade_full,
+            "AbsenceReasonId": record["AbsenceReasonId"],
+            "Narrative": None,
+            "StartDate": record["StartDate"],
+            "EndDate": record["EndDate"],
+        }
 
-            headers = {
-                "accept": "application/json;odata.metadata=minimal;odata.streaming=true; version=1",
-                "Authorization": f"Bearer {cascade_token}",
-                "Content-Type": "application/json;odata.metadata=minimal;odata.streaming=true; version=1"
-            }
+        params = {
+            "autoGenerateDaysBasedOnWorkingPattern": "true"
+        }
 
-            response = requests.post(cascade_absences_url, params=params, headers=headers, json=new_record)
+        headers = {
+            "accept": "application/json;odata.metadata=minimal;odata.streaming=true; version=1",
+            "Authorization": f"Bearer {cascade_token}",
+            "Content-Type": "application/json;odata.metadata=minimal;odata.streaming=true; version=1"
+        }
 
-            json_response = response.json()
+        key = f'{Cascade_full} {record["StartDate"]}'
+        operations.append(writeOperation(key, "POST", cascade_absences_url, "cascade_absences", (201,), params=params, headers=headers, json=new_record))
 
-            trackingID = json_response.get("id")
+    outcomes = runWrites(operations)
+
+    for outcome in outcomes:
+        if outcome["ok"]:
+            trackingID = outcome["response"].json().get("id")
             print (f'                   {trackingID}')
-                    
-            if response.status_code == 201:
-                json_response = response.json()
-                trackingID = json_response.get("id")
-            elif response.status_code == 429:
-                print(f'                Failed to create absence. Rate Limit hit') 
-            else:
-                print("        "+f'Response Code: {response.status_code}')    
-            time.sleep(0.2)
+        elif outcome["status"] == 429:
+            print(f'                Failed to create absence. Rate Limit hit') 
+        else:
+            print("        "+f'Response Code: {outcome["status"] or outcome["error"]}')    
 
-        exportData("005 - Absences to Cascade","010 - ADPabsences.json",output)    
-        
+    exportData("005 - Absences to Cascade","010 - ADPabsences.json",output)    
+    exportData("005 - Absences to Cascade","010a - Absence write report.json",writeReport(outcomes))    
+
+    return outcomes
 
 def DeleteAbsences(delete_ids):
     '''Deletes absences that are in cascade but not in adp
     
     Args:   delete_ids(list): All absence ids that need to be deleted.
+
+    Return: outcomes (list): Per-record write outcomes from runWrites
     
     '''
 
     exportData("005 - Absences to Cascade","011 - All deleted -ID.json",delete_ids)    
 
+    operations = []
     for ID_to_delete in delete_ids:
         api_url = f'https://api.iris.co.uk/hr/v2/attendance/absences/{ID_to_delete}'
 
@@ -1543,19 +2915,26 @@ def DeleteAbsences(delete_ids):
             'Content-Type': 'application/json;odata.metadata=minimal;odata.streaming=true; version=1',
         }
         
-        response = requests.delete(api_url, headers=headers)
-        
+        operations.append(writeOperation(ID_to_delete, "DELETE", api_url, "cascade_absences", (204,), headers=headers))
+
+    outcomes = runWrites(operations)
+
+    for outcome in outcomes:
+        ID_to_delete = outcome["key"]
         # Check if the deletion was successful
-        if response.status_code == 204:
+        if outcome["ok"]:
             print(f'                Successfully deleted absence with ID: {ID_to_delete}')
-        elif response.status_code == 404:
+        elif outcome["status"] == 404:
             print(f'                Failed to delete absence with ID: {ID_to_delete}. ID not recognsed in system')
-        elif response.status_code == 429:
+        elif outcome["status"] == 429:
             print(f'                Failed to delete absence with ID: {ID_to_delete}. Rate Limit hit') 
         else:
-            print(f'                Failed to delete absence with ID: {ID_to_delete}. Status code: {response.status_code}')
-    
-        time.sleep(0.6)  
+            print(f'                Failed to delete absence with ID: {ID_to_delete}. Status code: {outcome["status"] or outcome["error"]}')
+
+    if outcomes:
+        exportData("005 - Absences to Cascade","011a - Delete write report.json",writeReport(outcomes))    
+
+    return outcomes
 #---------------------------------------- Top Level Function               
 def DeleteEventNotification(id):
     '''deletes an event notification after it has been downloaded/ achknowledged'''
@@ -1567,12 +2946,17 @@ def DeleteEventNotification(id):
         'roleCode': 'employee'
     }
 
-    requests.delete(delete_url, cert=(certfile, keyfile), headers=api_headers)
+    response = httpRequest("DELETE", delete_url, headers=api_headers)
+
+    if response.status_code not in (200, 202, 204):
+        print(f"        Failed to acknowledge event {id}. Status code: {response.status_code}")
+        return False
+    return True
 
 def GetEventsAdp():
-    '''Downloads a single event notification.
+    '''Downloads the event notification at the head of the queue. The message is not acknowledged here.
     
-    Return: associate_oid (list): All staff IDs that have an event notification
+    Return: event (tuple): (adp_msg_id, associate_oid, event_time) - None when the queue is empty
 
     '''
     page_size = 100
@@ -1607,88 +2991,255 @@ def GetEventsAdp():
         print("No associateOID found, stopping.")
         return None
 
-    DeleteEventNotification(adp_msg_id)
+    return adp_msg_id, associate_oid, eventTime(data["events"][0])
 
-    return associate_oid  # Return the value instead of recursing
+def eventTime(event):
+    '''Finds when an ADP event was raised, falling back to now when the event carries no usable time
 
-def FindEventAoid():
-    '''Downloads all event notifications from ADP
-    
-    Return: associate_oid_list (list): All ADP ids that have requested at least one change
-    
+    Args:   event (dict): single event from the notification message
+
+    Return: event_time (dt): timezone aware event time
+    '''
+    for field in ("recordDateTime", "creationDateTime"):                  # effectiveDateTime is a business date, not when the event was raised
+        value = event.get(field)
+        if not value:
+            continue
+        try:
+            event_time = datetime.fromisoformat(str(value).replace("Z", "+00:00"))
+        except ValueError:
+            continue
+        return event_time if event_time.tzinfo else event_time.replace(tzinfo=timezone.utc)
+    return datetime.now(timezone.utc)
+
+def drainEvents():
+    '''Drains the ADP event queue, yielding the AOID and time of every event.
+        A message is only acknowledged once the caller has taken its AOID (the generator resumes), and it is
+        acknowledged before the next one is fetched, so the same message is never read twice.
+
+    Yield:  associate_oid (str): ADP id that has requested at least one change
+            event_time (dt): when the event was raised
     '''
     print(f"       Downloading event Notifications")
-    associate_oid_list = []
+    seen_aoids = set()
+    messages = 0
 
     while True:
-        oid = GetEventsAdp()
+        event = GetEventsAdp()
+
+        if event is None:
+            break
+
+        adp_msg_id, associate_oid, event_time = event
 
-        if oid is None:
-            print(f"Stopping. Collected {len(associate_oid_list)} OIDs.")
+        messages += 1
+        seen_aoids.add(associate_oid)
+        yield associate_oid, event_time                                 # Recorded by the caller before the ack is sent
+
+        if not DeleteEventNotification(adp_msg_id):
+            print(f"        Event {adp_msg_id} could not be acknowledged, stopping.")
             break
 
-        associate_oid_list.append(oid)
+    print(f"Stopping. Collected {len(seen_aoids)} OIDs from {messages} events.")
+
+def markAbsenceSync(country, aoid, started):
+    '''Records that an employee's absences were synced, as of the time the sync started less event_clock_skew_seconds
+
+    Args:   country (str): usa or can
+            aoid (str): ADP id of the employee
+            started (dt): when the sync started - events raised before this are covered
+    '''
+    started = started - timedelta(seconds=event_clock_skew_seconds)
+    with absence_sync_marks_lock:
+        mark = absence_sync_marks.get((country, aoid))
+        if mark is None or started > mark:
+            absence_sync_marks[(country, aoid)] = started
+
+class EventAccumulator:
+    ''' Coalesces daytime events by AOID and releases them in batches.
+
+        Each AOID keeps the time of its latest event. A batch is released once event_batch_size AOIDs are waiting,
+        or event_batch_window seconds after the first event of the batch, whichever comes first. AOIDs whose last
+        successful sync started after their latest event (absence_sync_marks) are dropped from the batch.
+    '''
+
+    def __init__(self, country, process_batch):
+        self.country = country
+        self.process_batch = process_batch
+        self.pending = {}                                               # AOID -> latest event time
+        self.timer = None
+        self.events = 0
+        self.released = 0
+        self.skipped = 0
+        self.lock = threading.Lock()
+
+    def add(self, aoid, event_time):
+        '''Records an event, releasing the batch if it has reached event_batch_size'''
+        with self.lock:
+            self.events += 1
+            latest = self.pending.get(aoid)
+            if latest is None or event_time > latest:
+                self.pending[aoid] = event_time
+
+            if len(self.pending) >= event_batch_size:
+                self.release()
+            elif self.timer is None:
+                self.timer = threading.Timer(event_batch_window, self.flush)
+                self.timer.daemon = True
+                self.timer.start()
+
+    def flush(self):
+        '''Releases whatever is waiting - called by the window timer and once the drain has finished'''
+        with self.lock:
+            self.release()
+
+    def release(self):
+        '''Hands the waiting AOIDs on. Runs with the lock held so a late timer cannot release after the final flush'''
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+
+        batch, self.pending = self.pending, {}
+        due = []
+        with absence_sync_marks_lock:
+            for aoid, event_time in batch.items():
+                mark = absence_sync_marks.get((self.country, aoid))
+                if mark is not None and mark >= event_time:
+                    self.skipped += 1
+                    continue
+                due.append(aoid)
+
+        if due:
+            self.released += len(due)
+            self.process_batch(due)
+
+def syncEmployeeAbsences(record,ID_library,absence_reasons,ninety_days_ago,absences_from,absences_by_employee=None):
+    ''' Reconciles the absences for a single member of staff. Errors are reported and contained
+        so one employee cannot stop the rest of the run.
+
+    Args:   record (dict): ID library entry for the member of staff
+            ID_library (IDLibrary): Lookup table for ADP staff
+            absence_reasons (list): Conversion table from USA/CAN absence reasons to Cascade absence reasons
+            ninety_days_ago (dt): Used to limit cascade response to same as adp response
+            absences_from (str): ninety_days_ago formatted for the Cascade filter
+            absences_by_employee (dict): Pre-grouped Cascade absences (bulk mode) - Nullable for a call per employee
+
+    Return: synced (bool): False when the employee could not be reconciled
+    '''
+    CascadeId = record["CascadeId"]
+    print(f"Updating absences for {CascadeId}")
     
-    return associate_oid_list
+    try:
+        Cascade_full, AOID = getCascadeId(CascadeId,ID_library)            
+
+        adp_response = getAbsencesAdp(AOID)                               #Downloads the absences in the last 90 days for a given staff member
+
+        if len(adp_response) == 0:
+            print(f"        No absences for {CascadeId}")
+            return True  # If there are no absences, skip to the next record                
+
+        adp_current = convertAdpAbsencesToCascadeFormat(adp_response,absence_reasons,Cascade_full,ninety_days_ago)                             # Converts ADP absences into Cascade format
+        cascade_current, current_absence_id_cascade = cascadeAbsences(Cascade_full,absences_from,absences_by_employee)                              # Pulls list of current absences
+        new_records, Update_transformed, delete_ids, update_ids = combineJsonFilesForPost(current_absence_id_cascade,adp_current,cascade_current)   # Compares adp and cascade and removes any that are already in cascade
+
+        DeleteAbsences(delete_ids)  # Deletes cancelled absences
+        PostAbsences(new_records,Cascade_full)  # Creates new absences
+
+    except json.JSONDecodeError as e:
+        if str(e) == "Expecting value: line 1 column 1 (char 0)":
+            print("         No absences booked within the last 90 days")
+            return True
+        print(f"JSON decoding error: {e}")
+        return False
+    except Exception as e:
+        line_number = sys.exc_info()[-1].tb_lineno
+        error_message = f"      Error processing CascadeId {CascadeId} on line {line_number}: {e}"
+        print(error_message)
+        return False
+
+    return True
 
 #---------------------------------------- Top Level Function               
-def runType2(ID_library):
-    '''Syncs absences from ADP to Cascade'''
+def runType2(ID_library,aoids=None):
+    '''Syncs absences from ADP to Cascade
+
+    Args:   ID_library (IDLibrary): Lookup table for ADP staff
+            aoids (list): Staff to reconcile during the day (service mode) - Nullable to drain the ADP event queue
+    '''
 
-    global adp_absence_categories
+    global adp_absence_categories, adp_absence_responses
     adp_absence_categories = []
+    adp_absence_responses = {}
 
     ninety_days_ago = datetime.now() - timedelta(days=90)                                                   # ADP only returns last 90, this allows the same for cascade
     absences_from = ninety_days_ago.strftime('%Y-%m-%dT%H:%M:%S.000Z')
 
     absence_reasons = createAbsencesReasons()
 
-    filtered_id_library = ID_library
-
-    #if c =="usa" and 
-    #if datetime.today().weekday() < 5:        
-    if overnight is False:
-        print (len(ID_library))
-        filter = FindEventAoid()
-        associate_oid_list = list(set(filter))
-        filtered_id_library = [entry for entry in ID_library if entry["AOID"] in associate_oid_list]
-        print (len(filtered_id_library))
-
-    for record in filtered_id_library:
-        CascadeId = record["CascadeId"]
-        print(f"Updating absences for {CascadeId}")
-        Cascade_full, AOID = getCascadeId(CascadeId,ID_library)            
-        
+    absences_by_employee = None
+    if overnight and absence_bulk_download:
         try:
-            adp_response = getAbsencesAdp(AOID)                               #Downloads the absences in the last 90 days for a given staff member
-
-            if len(adp_response) == 0:
-                print(f"        No absences for {CascadeId}")
-                continue  # If there are no absences, skip to the next record                
+            absences_by_employee = cascadeAbsencesBulk(absences_from)
+        except RuntimeError as e:
+            print(f"        Bulk absence download failed, asking Cascade per employee instead: {e}")
+
+    with ThreadPoolExecutor(max_workers=max(1, absence_employee_workers)) as executor:
+        #if c =="usa" and 
+        #if datetime.today().weekday() < 5:        
+        if overnight is False:
+            # Events are coalesced by AOID and each batch is reconciled while the rest of the queue is still draining
+            print (len(ID_library))
+            country = c
+            matched = []
+            in_flight = set()                                                           # AOIDs being synced right now
+            rerun = set()                                                               # ... that had another event while syncing
+            in_flight_lock = threading.Lock()
+
+            def syncAndMark(records, aoid):
+                while True:
+                    started = datetime.now(timezone.utc)
+                    synced = [syncEmployeeAbsences(record,ID_library,absence_reasons,ninety_days_ago,absences_from,absences_by_employee) for record in records]
+                    if all(synced):
+                        markAbsenceSync(country, aoid, started)
+                    with in_flight_lock:
+                        if aoid not in rerun:
+                            in_flight.discard(aoid)
+                            return
+                        rerun.discard(aoid)
+
+            def syncBatch(batch_aoids):
+                for aoid in batch_aoids:
+                    positions = ID_library.positions("AOID", aoid)                    # Every library row for the AOID, as the old filter synced
+                    if not positions:
+                        continue
+                    with in_flight_lock:
+                        if aoid in in_flight:                                           # Never sync one employee twice at once
+                            rerun.add(aoid)
+                            continue
+                        in_flight.add(aoid)
+                    matched.append(aoid)
+                    executor.submit(syncAndMark, [ID_library[position] for position in positions], aoid)
+
+            accumulator = EventAccumulator(country, syncBatch)
+            if aoids is not None:
+                requested_at = datetime.now(timezone.utc)                               # Explicit requests are always newer than the last sync
+                events = ((aoid, requested_at) for aoid in aoids)
             else:
-                adp_current = convertAdpAbsencesToCascadeFormat(adp_response,absence_reasons,Cascade_full,ninety_days_ago)                             # Converts ADP absences into Cascade format
-                cascade_current, current_absence_id_cascade = cascadeAbsences(Cascade_full,absences_from)                                                   # Pulls list of current absences
-                new_records, Update_transformed, delete_ids, update_ids = combineJsonFilesForPost(current_absence_id_cascade,adp_current,cascade_current)   # Compares adp and cascade and removes any that are already in cascade
-
-            DeleteAbsences(delete_ids)  # Deletes cancelled absences
-            PostAbsences(new_records,Cascade_full)  # Creates new absences
+                events = drainEvents()
+            for aoid, event_time in events:
+                accumulator.add(aoid, event_time)
+            accumulator.flush()
 
-
-        except json.JSONDecodeError as e:
-            if str(e) == "Expecting value: line 1 column 1 (char 0)":
-                print("         No absences booked within the last 90 days")
-            else:
-                print(f"JSON decoding error: {e}")
-        except Exception as e:
-            line_number = sys.exc_info()[-1].tb_lineno
-            error_message = f"      Error processing CascadeId {CascadeId} on line {line_number}: {e}"
-            print(error_message)
-            continue
+            print (len(matched))
+            print (f"        {accumulator.events} events, {accumulator.released} staff released, {accumulator.skipped} already up to date")
+        else:
+            for record in ID_library:
+                executor.submit(syncEmployeeAbsences,record,ID_library,absence_reasons,ninety_days_ago,absences_from,absences_by_employee)
     
     adp_absence_categories = list(set(adp_absence_categories))                                                                                             #Deduplicates list
     adp_absence_categories = [[v] for v in dict.fromkeys(adp_absence_categories)]
     uploadToGsheets(f"Absence Hierarchy ({c})","E:E","E1",adp_absence_categories)
     exportData("005 - Absences to Cascade", "001 - usa absence reasons from records.json", adp_absence_categories)
+    exportData("005 - Absences to Cascade","002 - ADP Raw absence response (Individual).json", adp_absence_responses)
 
 # Update Personal Details (Run Type 3)
 #---------------------------------------Support Functions
@@ -1696,11 +3247,17 @@ def makeApiRequest(DisplayId):
     ''' Finds the start date and Id from a cascade Id
 
     Args:   DisplayId (str): Internal Cascade Id (Front End)
+            The downloaded worker snapshot is used when it has the record, otherwise Cascade is asked directly.
 
     Return: Cascade_full_id (str): Cascade ID for backend
             cont_service (dt): Start Date for continuous service calculations.
     '''
 
+    snapshot = cascade_index["DisplayId"].get(DisplayId)                        # Already downloaded by getWorkersCascade
+    if snapshot is not None and snapshot.get("ContinuousServiceDate") is not None:
+        cont_service = datetime.fromisoformat(snapshot["ContinuousServiceDate"].replace("Z", "")).strftime('%Y-%m-%d')
+        return snapshot["Id"], cont_service
+
     api_params = {
         "$filter": f"DisplayId eq '{DisplayId}'",
         "$select": "DisplayId,Id,ContinuousServiceDate",
@@ -1712,7 +3269,6 @@ def makeApiRequest(DisplayId):
     cont_service_raw = response_data['value'][0]['ContinuousServiceDate']
     cont_service = datetime.fromisoformat(cont_service_raw.replace("Z", "")).strftime('%Y-%m-%d')
 
-    time.sleep(0.6)                                               #forces a wait to eliminate 429 errors
     return cascade_id_full, cont_service
 
 def loadCsvFromBucket(name):
@@ -1734,13 +3290,13 @@ def loadCsvFromBucket(name):
 
     return result
 
-def loadXlsxFromBucket(name):
-    bucket_name = "event_list_objects"
+def loadXlsxFromBucket(name, generation=None):
+    bucket_name = workbook_bucket
     file_name = f"{name}.xlsx"
 
-    # Reference the bucket and blob
+    # Reference the bucket and blob (pinned to a generation when one is given, so a replaced object cannot fail the read)
     bucket = storage_client.bucket(bucket_name)
-    blob = bucket.blob(file_name)
+    blob = bucket.blob(file_name, generation=generation)
 
     # Download file contents into memory
     data = blob.download_as_bytes()
@@ -1750,21 +3306,65 @@ def loadXlsxFromBucket(name):
 
     return xlsx_file
 
+def loadWorkbookSheets(name):
+    ''' Returns every sheet of a bucket workbook, parsed once per GCS object generation.
+        The generation is checked at most every workbook_check_seconds, so repeated lookups are served from memory.
+        If workbook_cache_dir is set the parsed sheets are also kept on disk between runs.
+
+    Args:   name (str): Workbook name in the bucket, without .xlsx
+
+    Return: sheets (dict): sheet name -> DataFrame (shared - do not modify in place)
+    '''
+    with workbook_lock:
+        entry = workbook_cache.get(name)
+        now = time.time()
+
+        if entry is not None and now - entry["checked"] < workbook_check_seconds:
+            return entry["sheets"]
+
+        blob = storage_client.bucket(workbook_bucket).blob(f"{name}.xlsx")
+        blob.reload()                                                           # Metadata only - gives the current generation
+        generation = blob.generation
+
+        if entry is not None and entry["generation"] == generation:
+            entry["checked"] = now
+            return entry["sheets"]
+
+        sheets = None
+        disk_path = Path(workbook_cache_dir) / f"{name}-{generation}.pkl" if workbook_cache_dir else None
+
+        if disk_path is not None and disk_path.exists():
+            sheets = pd.read_pickle(disk_path)
+
+        if sheets is None:
+            sheets = pd.read_excel(loadXlsxFromBucket(name, generation), sheet_name=None)
+            if disk_path is not None:
+                os.makedirs(disk_path.parent, exist_ok=True)
+                pd.to_pickle(sheets, disk_path)
+
+        workbook_cache[name] = {"generation": generation, "sheets": sheets, "checked": now}
+        return sheets
+
 def findCascadePersonalDataFromId(ADP_id, ID_library, display_id, start_date):
     '''Finds the continuous Service data and full cascade data for a given cascade Id and start Date) 
 
     Args:   ADP_id (tr): Internal identifier from ADP
-            ID_library (list): Lookup for ID values
+            ID_library (IDLibrary): Lookup for ID values
             display_id (str): FrontEnd Id from cascade
             startdate (dt): StartDatee from cascade record
 
     '''
-    match = next(
-        (entry for entry in ID_library
-         if (entry["ADP_number"] == ADP_id and entry["CascadeId"] is None)
-         or entry["CascadeId"] == display_id),
-        None
-    )
+    candidates = []
+
+    adp_position = ID_library.position("ADP_number", ADP_id)
+    if adp_position is not None and ID_library[adp_position]["CascadeId"] is None:
+        candidates.append(adp_position)
+
+    display_position = ID_library.position("CascadeId", display_id)
+    if display_position is not None:
+        candidates.append(display_position)
+
+    match = ID_library[min(candidates)] if candidates else None                 # Earliest record wins, as in the old list scan
 
     if match is None:
         return start_date, None
@@ -1832,7 +3432,7 @@ def convertAdpToCascadeForm(records,suffix,terminations,ID_library,x_months_ago=
     
     Args:   records (list): All ADP records to convert
             suffix(str): Identifies the terninated staff for conversion
-            ID_library (list): Data conversion list
+            ID_library (IDLibrary): Data conversion list
 
     Return: output (list): Converted ADP records            
     '''                         
@@ -1954,8 +3554,8 @@ def convertAdpToCascadeForm(records,suffix,terminations,ID_library,x_months_ago=
             # For non-terminated records, add all records
             output.append(transformed_record)
         
-        # Save individual dataset files
-        exportData("003 - Personal to Cascade",f"001 - ADP_to_cascade_{suffix}.json", output)    
+    # Save individual dataset files
+    exportData("003 - Personal to Cascade",f"001 - ADP_to_cascade_{suffix}.json", output)    
     
     return output
 
@@ -2012,8 +3612,53 @@ def cascadeRejigPersonal(cascade_responses):
     
     return cascade_reordered
 
+def recordFingerprint(record, ignored=()):
+    ''' Hashes a record's content so two records can be compared without walking every field
+
+    Args:   record (dict): record in cascade format
+            ignored (tuple): fields left out of the hash
+
+    Return: fingerprint (str): sha1 of the record's canonical json
+    '''
+    content = {k: v for k, v in record.items() if k not in ignored}
+    canonical = json.dumps(content, sort_keys=True, separators=(",", ":"), default=str)
+    return hashlib.sha1(canonical.encode("utf-8")).hexdigest()
+
+def changedFields(adp_record, cascade_record, ignored=()):
+    ''' Lists the fields whose values differ between an ADP record and its Cascade record
+
+    Args:   adp_record (dict): ADP record in cascade format
+            cascade_record (dict): matching record from cascadeRejigPersonal
+            ignored (tuple): fields that are never reported
+
+    Return: fields (list): names of the changed fields
+    '''
+    return [k for k, v in adp_record.items() if k not in ignored and cascade_record.get(k) != v]
+
+def indexCascadePersonal(cascade_reordered):
+    ''' Indexes reordered Cascade records by DisplayId and Id (first record wins)
+
+    Args:   cascade_reordered (list): All current staff in Cascade
+
+    Return: by_display (dict): DisplayId -> record
+            by_id (dict): Id -> record
+    '''
+    by_display = {}
+    by_id = {}
+    for record in cascade_reordered:
+        display_id = record.get("DisplayId")
+        record_id = record.get("Id")
+        if display_id not in (None, ""):
+            by_display.setdefault(display_id, record)
+        if record_id not in (None, ""):
+            by_id.setdefault(record_id, record)
+    return by_display, by_id
+
 def combineJsonFiles(adp_to_cascade_terminated,adp_to_cascade,cascade_reordered):
     ''' Categorises staff by employment status by comparing ADP and Cascade staff lists
+
+    Each ADP record is joined to its Cascade record on DisplayId (or Id) and the two fingerprints
+    are compared, so the whole comparison is a single pass over each list.
     
     Args:   adp_to_cascade_terminated (list): All terminated staff from ADP in cascade format
             adp_to_cascade (list): All current staff in ADP converted to cascade format
@@ -2026,27 +3671,47 @@ def combineJsonFiles(adp_to_cascade_terminated,adp_to_cascade,cascade_reordered)
 
     ct_combining_personal = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
     print ("        Generating a list of files that need updating (" + ct_combining_personal + ")")
-    
+
+    cascade_by_display, cascade_by_id = indexCascadePersonal(cascade_reordered)
+    cascade_fingerprints = {}
+
     unique_entries = []
-    for idx, entry in enumerate(adp_to_cascade):
-        if entry not in cascade_reordered:
-            adp_status = entry.get('WorkingStatus')
-            cascade_entry = cascade_reordered[idx]
-            cascade_status = cascade_entry.get('WorkingStatus')
-            if adp_status != cascade_status and not (adp_status == 'Current' and cascade_status == 'On Holiday'):
-                unique_entries.append((entry, idx))
-    
-    update_personal = [entry for entry, _ in unique_entries]
+    update_personal = []
+    new_starters = []
+    not_in_cascade = 0
+
+    for entry in adp_to_cascade:
+        display_id = entry.get('DisplayId')
+        if display_id in [None,""]:
+            new_starters.append(entry)
+            continue
 
-    new_starters = [entry for entry in adp_to_cascade if entry.get('DisplayId') in [None,""]]
-    print("             New Staff: "+str(len(new_starters)))
+        cascade_entry = cascade_by_display.get(display_id) or cascade_by_id.get(entry.get('Id'))
+        if cascade_entry is None:
+            # Has a Cascade identity but is missing from the download - report it, don't PUT blind
+            not_in_cascade += 1
+            unique_entries.append({"DisplayId": display_id, "Id": entry.get('Id'), "ChangedFields": None, "MissingFromCascade": True})
+            continue
+
+        key = id(cascade_entry)
+        if key not in cascade_fingerprints:
+            cascade_fingerprints[key] = recordFingerprint(cascade_entry, personal_ignored_fields)
+        if recordFingerprint(entry, personal_ignored_fields) == cascade_fingerprints[key]:
+            continue
+
+        changed = changedFields(entry, cascade_entry, personal_ignored_fields)
+        unique_entries.append({"DisplayId": display_id, "Id": entry.get('Id'), "ChangedFields": changed})
 
-    update_personal = [entry for entry in update_personal if entry.get('DisplayId') not in [None,""]]
+        if personal_update_trigger == "any" or "WorkingStatus" in changed:
+            update_personal.append(entry)
+
+    print("             New Staff: "+str(len(new_starters)))
     print("             Updating Staff: "+str(len(update_personal)))
+    if not_in_cascade:
+        print("             Staff with a DisplayId missing from Cascade (skipped): " + str(not_in_cascade))
 
-    unterminated_staff = [entry for entry in adp_to_cascade_terminated 
-                            if any(c.get('DisplayId') == entry.get('DisplayId') and c.get('LastWorkingDate') is None 
-                            for c in cascade_reordered)]
+    open_cascade_ids = {record.get('DisplayId') for record in cascade_reordered if record.get('LastWorkingDate') is None}
+    unterminated_staff = [entry for entry in adp_to_cascade_terminated if entry.get('DisplayId') in open_cascade_ids]
     print("             Terminated Staff not in Cascade: " + str(len(unterminated_staff)))
 
     processed_unterminated_records = []
@@ -2085,16 +3750,21 @@ def combineJsonFiles(adp_to_cascade_terminated,adp_to_cascade,cascade_reordered)
 
     return update_personal, new_starters, processed_unterminated_records
 
-def PutCascadeWorkersPersonal(list_of_staff):
+def PutCascadeWorkersPersonal(list_of_staff,report_name="006a - Personal write report.json"):
     ''' Takes list of staff who need updating and performs PUT api call
 
     Args:   list_of_staff (list): All staff who have a minor change in their data
+            report_name (str): File the per-record outcomes are exported to
+
+    Return: outcomes (list): Per-record write outcomes from runWrites
 
     '''
     
     time_now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
     print ("        Updating Staff changes (" + time_now + ")")                         
     
+    queued = []
+    operations = []
     for entry in list_of_staff:
         employee_id = entry.get("Id")
         display_id = entry.get("DisplayId")
@@ -2118,23 +3788,37 @@ def PutCascadeWorkersPersonal(list_of_staff):
             'Content-Length': '22',
         }
                 
-        response = requests.put(api_url, headers=headers, json=transformed_record)
+        queued.append(entry)
+        operations.append(writeOperation(display_id, "PUT", api_url, "cascade_workers", (204,), headers=headers, json=transformed_record))
+
+    outcomes = runWrites(operations)
+
+    for entry, outcome in zip(queued, outcomes):
+        display_id = entry.get("DisplayId")
+        FirstName = entry.get("FirstName")
+        LastName = entry.get("LastName")
         
-        if response.status_code == 204:
-            print("             " + f'Personal information transfer for {FirstName} {LastName} ({display_id}) complete. {response.status_code}')
+        if outcome["ok"]:
+            print("             " + f'Personal information transfer for {FirstName} {LastName} ({display_id}) complete. {outcome["status"]}')
         else:
-            print("             " + f'Data Transfer for {FirstName} {LastName} - {display_id} has failed. Response Code: {response.status_code}')           
-        time.sleep(0.6) 
+            print("             " + f'Data Transfer for {FirstName} {LastName} - {display_id} has failed. Response Code: {outcome["status"] or outcome["error"]}')           
+
+    exportData("003 - Personal to Cascade",report_name,writeReport(outcomes))    
+
+    return outcomes
     
 def PostNewStarters(new_starters): 
     ''' Takes list of staff who need adding and performs POST api call
 
     Args:   new_starters (list): All staff who have no personal data record on Cascade
 
+    Return: outcomes (list): Per-record write outcomes from runWrites
+
     '''
     
     time_now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
     print ("        Adding new staff (" + time_now + ")")                              
+    operations = []
     for entry in new_starters:
         FirstName = entry.get("FirstName")
         LastName = entry.get("LastName")
@@ -2150,13 +3834,19 @@ def PostNewStarters(new_starters):
             'Content-Type': 'application/json;odata.metadata=minimal;odata.streaming=true; version=2',
         }
         
-        response = requests.post(cascade_workers_base, headers=headers, json=transformed_record)
+        operations.append(writeOperation(f"{FirstName} {LastName}", "POST", cascade_workers_base, "cascade_workers", (201,), headers=headers, json=transformed_record))
+
+    outcomes = runWrites(operations)
 
-        if response.status_code == 201:
-            print("             " + f'New Starter Added ({FirstName} {LastName})')
+    for outcome in outcomes:
+        if outcome["ok"]:
+            print("             " + f'New Starter Added ({outcome["key"]})')
         else:
-            print("             "+f'Data Transfer for New Starter ({FirstName} {LastName}) has failed. Response Code: {response.status_code}')           
-        time.sleep(0.6)  
+            print("             "+f'Data Transfer for New Starter ({outcome["key"]}) has failed. Response Code: {outcome["status"] or outcome["error"]}')           
+
+    exportData("003 - Personal to Cascade","006c - New starter write report.json",writeReport(outcomes))    
+
+    return outcomes
 
 #---------------------------------------- Top Level Function   
 def runType3():
@@ -2174,17 +3864,15 @@ def runType3():
     cascade_reordered                                           = cascadeRejigPersonal(cascade_responses)
     records_to_upload, new_starters, unterminated_staff         = combineJsonFiles(adp_to_cascade_terminated,adp_to_cascade,cascade_reordered)
     PutCascadeWorkersPersonal(records_to_upload)
-    PutCascadeWorkersPersonal(unterminated_staff)
+    PutCascadeWorkersPersonal(unterminated_staff,"006b - Leaver write report.json")
     PostNewStarters(new_starters)   
 
 # Update Job Details (Run Type 4)
 #---------------------------------------Support Functions
-def createParams(page_size, skip_param):
-    ''' Creates the api paramaters for job api calls'''
+def createParams():
+    ''' Creates the api paramaters for job api calls (paging is added by getCascadeCollection)'''
     api_params = {
         "$filter": "EndDate eq null",
-        "$top": page_size,
-        "$skip": skip_param
     }
     return api_params 
 
@@ -2204,42 +3892,43 @@ def findContract(c,worker,active_job_position):
 def searchIdLibrary(ID_library,ADP_id):
     ''' Finds support info from ID library
 
-    Args:   ID_library (List): ADP lookup table
+    Args:   ID_library (IDLibrary): ADP lookup table
             ADP_id (str): Internal ADP identifier
 
     Return: employee_id (str): Cascade internal id
             hierarchy_id (str): Internal Id for given hierarchy node
     '''
     
-    for record in ID_library:
-        if record["ADP_number"]==ADP_id:
-            employee_id = record["Cascade_full"]
-            hierarchy_id = record["Hierarchy"]
-            break
+    record = ID_library.find("ADP_number", ADP_id)
+
+    if record is None:
+        raise ValueError(f"No record found for ADP number: {ADP_id}")
+
+    employee_id = record["Cascade_full"]
+    hierarchy_id = record["Hierarchy"]
     return employee_id,hierarchy_id   
 
 def findLineManager(ID_library,LM_AOID,employee_id):
     ''' Find line manager for given staff member
 
-    Args:   ID_library (List): ADP lookup table
+    Args:   ID_library (IDLibrary): ADP lookup table
             LM_AOID (str): ADP AOID for the staff members Line Manager
             employee_id (str):  Employee Id (Cascade frontend)
     
     Return: line_manager (str): Cascade backend Id for line manager    
     '''
 
-    xlsx_in_memory = loadXlsxFromBucket("Hierarchy")
-    df = pd.read_excel(xlsx_in_memory, sheet_name='JJ')
-    reports_to_JJ = df['ID'].tolist()
+    df = loadWorkbookSheets("Hierarchy")['JJ']
+    reports_to_JJ = set(df['ID'].tolist())
 
     if employee_id in reports_to_JJ:                            #JJ
         line_manager = "b3775d20-8d33-4ca9-aaad-5e2346bb17e9"
     if LM_AOID == "G3BFJBFXG2J1KB05":
         line_manager = "6f3f3e39-f6cb-4dfe-94d8-688a17ac092c"
     else:
-        for record in ID_library:
-            if record["AOID"]==LM_AOID:
-                line_manager = record["Cascade_full"]   
+        record = ID_library.findLast("AOID", LM_AOID)              # The old scan had no break, so the last match won
+        if record is not None:
+            line_manager = record["Cascade_full"]   
     return line_manager
 
 def choosePaybasis(paybasis_hourly):
@@ -2320,7 +4009,7 @@ def findNewStarters(records_to_add,ID_library):
     ''' Identifies new starters in the ID library
     
     Args:   records_to_add(list): All new starters
-            ID_library (List): ADP lookup table
+            ID_library (IDLibrary): ADP lookup table
     
     Return: new_start_jobs(list): All staff who will need a job line adding
      
@@ -2337,7 +4026,7 @@ def findNewStarters(records_to_add,ID_library):
 def findName(employeeId):
     '''Generates employee Name from employeeId'''
 
-    match = next((item for item in cascade_responses if item["Id"] ==employeeId),None)
+    match = cascade_index["Id"].get(employeeId)
 
     if match:
         full_name = f"{match['KnownAs']} {match['LastName']}"
@@ -2358,23 +4047,10 @@ def cascadeCurrentJobs():
 
     page_size = 200
 
-    api_params = createParams(page_size,0)
-
-    api_response = apiCallCascade(cascade_token,cascade_jobs_url,api_params)
-    api_calls = apiCountCascade(api_response,page_size)
-
-    cascade_jobs = []
-
-    for i in range(api_calls):
-        skip_param = i * page_size
-        api_params = createParams(page_size,skip_param)
-
-        api_response = apiCallCascade(cascade_token,cascade_jobs_url,api_params)
+    api_params = createParams()
+    api_params.update(projectionParams(cascade_job_fields) or {})
 
-        if api_response.status_code == 200:
-            json_data = api_response.json()
-            json_data = json_data['value']
-            cascade_jobs.extend(json_data)    
+    cascade_jobs = getCascadeCollection(cascade_jobs_url,page_size,api_params)
 
     exportData("004 - Jobs to Cascade","001 - Cascade Jobs.json", cascade_jobs)    
 
@@ -2444,12 +4120,24 @@ def cascadeRejigJobs(cascade_current_jobs):
 
     return filtered_records
 
-def adpRejig(cascade_current,adp_responses,ID_library):
+def indexCascadeJobs(cascade_current):
+    ''' Indexes the current Cascade jobs by EmployeeId
+
+    Args:   cascade_current (list): most current job per employee from cascadeRejigJobs
+
+    Return: jobs_index (dict): EmployeeId -> current job record
+    '''
+    jobs_index = {}
+    for record in cascade_current:
+        jobs_index.setdefault(record.get("EmployeeId"), record)
+    return jobs_index
+
+def adpRejig(cascade_jobs_index,adp_responses,ID_library):
     ''' Rearranges adp_responses into cascade job records
 
-    Args:   cascade_current (list): All records of current staff in cascade
+    Args:   cascade_jobs_index (dict): Current cascade job per EmployeeId (indexCascadeJobs)
             adp_responses (list): All personal records of staff from ADP
-            ID_library (List): ADP lookup table
+            ID_library (IDLibrary): ADP lookup table
     
     Return: transformed_records (list): All staff whose records need updating
             new_start_jobs (list): All staff with no job line
@@ -2486,57 +4174,57 @@ def adpRejig(cascade_current,adp_responses,ID_library):
         salary,salary_rounded       = roundSalary(pay_hourly,pay_annual)     
         contract                    = changeContractLanguage(contract)
 
-        for record in cascade_current:
-            if record.get("EmployeeId") == employee_id:
-                Id = record.get("Id")
-                jobTitle = record.get("JobTitle")
-                JobFamily = record.get("JobFamily")
-                cascadeStart = record.get("StartDate")
-                notice = record.get("NoticePeriod")
-                classification = record.get("Classification")
-
-                effective_date_other = worker.get("workAssignments", [{}])[active_job_position].get("assignmentStatus", {}).get("effectiveDate")
-                startDate = findStartDate(effective_date_wage,cascadeStart,effective_date_other)
-
-                changeReason = findChangeReason(record,salary,hierarchy_id,line_manager,startDate)
-
-                transformed_record = {
-                    "JobTitle": jobTitle,
-                    "Classification": classification,
-                    "StartDate": startDate,                  
-                    "EndDate": None,
-                    "WorkingCalendar": "40hrs Monday to friday", 
-                    "LineManagerId": line_manager,
-                    "HierarchyNodeId": hierarchy_id,
-                    "Active": True,
-                    "Salary": salary_rounded,
-                    "EmployeeId": employee_id,
-                    "Contract": contract,
-                    "PayFrequency": pay_frequency,
-                    "PayBasis": paybasis,
-                    "FullTimeEquivalent": 1,                                                    #This is likely to change once working patterns in the US are described.
-                    "ChangeReason": changeReason,        
-                    "NextIncrementDate": None,
-                    "TimesheetLocation": None,
-                    "TimesheetLunchDuration": None,
-                    "ExpenseSubmissionFrequency": None,
-                    "CostCentre": None,
-                    "JobFamily": JobFamily,
-                    "ApprenticeUnder25": None,
-                    "ApprenticeshipEndDate": None,
-                    "ContractEndDate": None,
-                    "NormalHours": 40,
-                    "RealTimeInformationIrregularFrequency": None,
-                    "NoticePeriod": notice,
-                    "Id": Id                            
-                    }
-            
-                record_to_add = {
-                    "EmployeeId": employee_id,
+        record = cascade_jobs_index.get(employee_id)
+        if record is not None:
+            Id = record.get("Id")
+            jobTitle = record.get("JobTitle")
+            JobFamily = record.get("JobFamily")
+            cascadeStart = record.get("StartDate")
+            notice = record.get("NoticePeriod")
+            classification = record.get("Classification")
+
+            effective_date_other = worker.get("workAssignments", [{}])[active_job_position].get("assignmentStatus", {}).get("effectiveDate")
+            startDate = findStartDate(effective_date_wage,cascadeStart,effective_date_other)
+
+            changeReason = findChangeReason(record,salary,hierarchy_id,line_manager,startDate)
+
+            transformed_record = {
+                "JobTitle": jobTitle,
+                "Classification": classification,
+                "StartDate": startDate,                  
+                "EndDate": None,
+                "WorkingCalendar": "40hrs Monday to friday", 
+                "LineManagerId": line_manager,
+                "HierarchyNodeId": hierarchy_id,
+                "Active": True,
+                "Salary": salary_rounded,
+                "EmployeeId": employee_id,
+                "Contract": contract,
+                "PayFrequency": pay_frequency,
+                "PayBasis": paybasis,
+                "FullTimeEquivalent": 1,                                                    #This is likely to change once working patterns in the US are described.
+                "ChangeReason": changeReason,        
+                "NextIncrementDate": None,
+                "TimesheetLocation": None,
+                "TimesheetLunchDuration": None,
+                "ExpenseSubmissionFrequency": None,
+                "CostCentre": None,
+                "JobFamily": JobFamily,
+                "ApprenticeUnder25": None,
+                "ApprenticeshipEndDate": None,
+                "ContractEndDate": None,
+                "NormalHours": 40,
+                "RealTimeInformationIrregularFrequency": None,
+                "NoticePeriod": notice,
+                "Id": Id                            
                 }
+        
+            record_to_add = {
+                "EmployeeId": employee_id,
+            }
 
-                transformed_records.append(transformed_record)
-                records_to_add.append(record_to_add)
+            transformed_records.append(transformed_record)
+            records_to_add.append(record_to_add)
 
     new_start_jobs = findNewStarters(records_to_add,ID_library)
 
@@ -2551,7 +4239,7 @@ def adpRejigNewStarters(new_starters,adp_responses,ID_library):
 
     Args:   new_starters (list): New starters to add
             adp_responses (list): All personal records of staff from ADP
-            ID_library (List): ADP lookup table
+            ID_library (IDLibrary): ADP lookup table
     
     Return: transformed_records (list): Staff whose records need adding
     '''
@@ -2624,9 +4312,13 @@ def adpRejigNewStarters(new_starters,adp_responses,ID_library):
 
     return transformed_records
                         
-def classifyAdpFiles(new_start_jobs,adp_current,cascade_current):
+def classifyAdpFiles(new_start_jobs,adp_current,cascade_jobs_index):
     ''' Classify if jobs are for adding or updating.
 
+    Args:   new_start_jobs (list): job records for staff with no job on Cascade
+            adp_current (list): ADP job records from adpRejig
+            cascade_jobs_index (dict): Current cascade job per EmployeeId (indexCascadeJobs)
+
     Return: PUT_jobs(list): Job records that need to be updated
             POST_jobs(list): Job records that need to be added.    
             
@@ -2639,29 +4331,16 @@ def classifyAdpFiles(new_start_jobs,adp_current,cascade_current):
     POST_jobs = []
 
     for adp_record in adp_current:
-        matched = False
-        for cascade_record in cascade_current:
-            if adp_record == cascade_record:                                                                                                    # Compares and finds fully matching records                      
-                not_to_be_updated.append(adp_record)
-                matched = True
-                break
-            elif (adp_record["EmployeeId"] == cascade_record["EmployeeId"] and                                                                  # Same EmployeeId and StartDate but a different field - Needs updating   
-                adp_record["StartDate"] == cascade_record["StartDate"]):
-                PUT_jobs.append(adp_record)
-                matched = True
-                break
-            elif adp_record["EmployeeId"] == cascade_record["EmployeeId"] and adp_record["StartDate"] != cascade_record["StartDate"]:
-                POST_jobs.append(adp_record)                                                                                                    # Different StartDate - Needs a new line
-                matched = True
-                break
+        cascade_record = cascade_jobs_index.get(adp_record["EmployeeId"])
+        if cascade_record is None:
+            continue
 
-        # If no match is found in cascade_current, determine which list to add it to
-        if not matched:
-            if any(adp_record["EmployeeId"] == rec["EmployeeId"] for rec in cascade_current):
-                if any(adp_record["StartDate"] == rec["StartDate"] for rec in cascade_current):
-                    PUT_jobs.append(adp_record)
-                else:
-                    POST_jobs.append(adp_record)
+        if adp_record == cascade_record:
+            not_to_be_updated.append(adp_record)                                                                                                # Fully matching record
+        elif adp_record["StartDate"] == cascade_record["StartDate"]:
+            PUT_jobs.append(adp_record)                                                                                                         # Same StartDate but a different field - Needs updating
+        else:
+            POST_jobs.append(adp_record)                                                                                                        # Different StartDate - Needs a new line
     
     print (f"           {len(not_to_be_updated)} records do not need to be updated.")
     print (f"           {len(PUT_jobs)} records DO need to be updated.")
@@ -2676,9 +4355,14 @@ def classifyAdpFiles(new_start_jobs,adp_current,cascade_current):
     return PUT_jobs, POST_jobs
 
 def PutUpdateJobChange(PUT_jobs):
-    '''Updates job records'''
+    '''Updates job records
+
+    Return: outcomes (list): Per-record write outcomes from runWrites
+    '''
 
     print ("            Updating records that are already present")
+    names = []
+    operations = []
     for record in PUT_jobs:
         update_record = {
         "JobTitle": record["JobTitle"],
@@ -2724,19 +4408,31 @@ def PutUpdateJobChange(PUT_jobs):
             'Content-Length': '22',
         }
         
-        response = requests.put(api_url, headers=headers, json=update_record)
-        
-        if response.status_code == 204:
+        names.append(full_name)
+        operations.append(writeOperation(Id, "PUT", api_url, "cascade_jobs", (204,), headers=headers, json=update_record))
+
+    outcomes = runWrites(operations)
+
+    for full_name, outcome in zip(names, outcomes):
+        if outcome["ok"]:
             print("        " + f'Current Job updated for {full_name} complete')
         else:
-            print("        "+f'Data Transfer for {full_name} has failed. Response Code: {response.status_code}')           
-        time.sleep(0.6)
+            print("        "+f'Data Transfer for {full_name} has failed. Response Code: {outcome["status"] or outcome["error"]}')           
+
+    exportData("004 - Jobs to Cascade","006a - Job update write report.json",writeReport(outcomes))    
+
+    return outcomes
 
 def PostCreateJobs(POST_jobs, new_start_jobs):
-    '''Adds in new job records'''      
+    '''Adds in new job records
+
+    Return: outcomes (list): Per-record write outcomes from runWrites
+    '''      
     print ("            Adding new job lines")
     combined_list = POST_jobs + new_start_jobs
 
+    names = []
+    operations = []
     for record in combined_list:
         update_record = {
         "JobTitle": record["JobTitle"],
@@ -2780,13 +4476,20 @@ def PostCreateJobs(POST_jobs, new_start_jobs):
 #                'Content-Length': '22',
         }
         
-        response = requests.post(api_url, headers=headers, json=update_record)
-        
-        if response.status_code == 201:
+        names.append(full_name)
+        operations.append(writeOperation(employeeId, "POST", api_url, "cascade_jobs", (201,), headers=headers, json=update_record))
+
+    outcomes = runWrites(operations)
+
+    for full_name, outcome in zip(names, outcomes):
+        if outcome["ok"]:
             print("        " + f'New Job line added for {full_name} complete')
         else:
-            print("        "+f'Data Transfer for {full_name} has failed. Response Code: {response.status_code}')           
-        time.sleep(0.6)
+            print("        "+f'Data Transfer for {full_name} has failed. Response Code: {outcome["status"] or outcome["error"]}')           
+
+    exportData("004 - Jobs to Cascade","006b - Job line write report.json",writeReport(outcomes))    
+
+    return outcomes
 
 #---------------------------------------- Top Level Function               
 def run_type_4():
@@ -2797,57 +4500,247 @@ def run_type_4():
     
     cascade_jobs                        = cascadeCurrentJobs()
     cascade_current                     = cascadeRejigJobs(cascade_jobs)
-    adp_current,new_starters_jobs       = adpRejig(cascade_current,adp_responses,ID_library)
+    cascade_jobs_index                  = indexCascadeJobs(cascade_current)
+    adp_current,new_starters_jobs       = adpRejig(cascade_jobs_index,adp_responses,ID_library)
     new_start_jobs                      = adpRejigNewStarters(new_starters_jobs,adp_responses,ID_library)
-    PUT_jobs, POST_jobs                 = classifyAdpFiles(new_start_jobs,adp_current,cascade_current)
+    PUT_jobs, POST_jobs                 = classifyAdpFiles(new_start_jobs,adp_current,cascade_jobs_index)
     PutUpdateJobChange(PUT_jobs)
     PostCreateJobs(POST_jobs, new_start_jobs)
 
+# Service Mode
+#---------------------------------------Support Functions
+def prepareCountry(country):
+    ''' Loads keys, sessions and tokens for a country and makes them the active globals.
+        Keys and the temporary certificate files are kept per country, so a resident service only builds them once.
+
+    Args:   country (str): usa or can
+    '''
+    global c, access_token, cascade_token, certfile, keyfile, strings_to_exclude
+    global data_store, country_hierarchy_USA, country_hierarchy_CAN
+
+    state = country_state.get(country)
+    if state is None:
+        client_id, client_secret, excluded, hierarchy_usa, hierarchy_can, cascade_API_id, key_content, cert_content = loadKeys(country)
+        cert_path, key_path = loadSsl(cert_content, key_content)
+        state = {
+            "client_id": client_id,
+            "client_secret": client_secret,
+            "strings_to_exclude": excluded,
+            "country_hierarchy_USA": hierarchy_usa,
+            "country_hierarchy_CAN": hierarchy_can,
+            "cascade_API_id": cascade_API_id,
+            "certfile": cert_path,
+            "keyfile": key_path,
+        }
+        country_state[country] = state
+
+    c = country
+    data_store = dataStoreLocation(country)
+    strings_to_exclude = state["strings_to_exclude"]
+    country_hierarchy_USA = state["country_hierarchy_USA"]
+    country_hierarchy_CAN = state["country_hierarchy_CAN"]
+    certfile, keyfile = state["certfile"], state["keyfile"]
+
+    startSessions(country, certfile, keyfile)
+    access_token = getToken(credentialKey("adp", country, state["client_id"]), lambda: adpBearer(state["client_id"],state["client_secret"],state["certfile"],state["keyfile"]), "access_token")
+    cascade_token = getToken(credentialKey("cascade", state["cascade_API_id"]), lambda: cascadeBearer(state["cascade_API_id"]), "cascade_token")
+
+def serviceLibrary(country, reload=False):
+    ''' Returns the ID library for a country, loading it from BigQuery when asked to or when it is stale.
+        The overnight run truncates and streams the table, so its modified time can't say when the load has
+        finished - the library is reloaded on every /trigger and after service_library_check_seconds otherwise.
+
+    Args:   country (str): usa or can
+            reload (bool): load the table even if a recent copy is held
+
+    Return: ID_library (IDLibrary): Id Library for use in event-driven absences
+    '''
+    entry = service_libraries.get(country)
+    now = time.monotonic()
+    if not reload and entry is not None and now - entry["loaded"] < service_library_check_seconds:
+        return entry["library"]
+
+    entry = {"library": import_from_bq(creds,project_Id,country), "loaded": now}
+    service_libraries[country] = entry
+    print (f"    ID library loaded for {country} ({len(entry['library'])} records)")
+    return entry["library"]
+
+def serviceAuthorised(headers):
+    ''' Checks the shared service token on a request
+
+    Args:   headers: request headers
+
+    Return: authorised (bool): True when service_token is set and the caller sent it
+    '''
+    if not service_token:
+        return False
+
+    sent = headers.get("X-Service-Token")
+    if sent is None:
+        authorization = headers.get("Authorization") or ""
+        if authorization.startswith("Bearer "):
+            sent = authorization[len("Bearer "):]
+    if not sent:
+        return False
+    return hmac.compare_digest(sent.encode("utf-8"), service_token.encode("utf-8"))
+
+def serviceRun(run_countries, aoids=None):
+    ''' Runs the daytime absence sync for each country using the warm state
+
+    Args:   run_countries (list): countries to sync
+            aoids (list): Staff to reconcile - Nullable to drain the ADP event queue
+
+    Return: results (dict): country -> seconds taken
+    '''
+    global overnight
+    results = {}
+
+    with service_lock:
+        overnight = False
+        for country in run_countries:
+            started = time.monotonic()
+            time_now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+            print (f"Service sync for {country} (" + time_now + ")")
+
+            prepareCountry(country)
+            runType2(serviceLibrary(country, reload=aoids is None), aoids)
+            flushExports()
+            results[country] = round(time.monotonic() - started, 2)
+
+    return results
+
+class ServiceHandler(BaseHTTPRequestHandler):
+    ''' Endpoints for service mode
+
+        GET  /health     liveness check
+        POST /trigger    drains the ADP event queue - body {"country": "usa"} is optional
+        POST /absences   reconciles the given staff - body {"aoids": [...], "country": "usa"}
+
+        Both POSTs need the service_token (SERVICE_TOKEN) in an "Authorization: Bearer" or "X-Service-Token"
+        header. With no token set every POST is refused.
+    '''
+
+    def do_GET(self):
+        if urlparse(self.path).path == "/health":
+            self.reply(200, {"status": "ok"})
+        else:
+            self.reply(404, {"error": "not found"})
+
+    def do_POST(self):
+        path = urlparse(self.path).path
+        if path not in ("/trigger", "/absences"):
+            self.reply(404, {"error": "not found"})
+            return
+
+        if not serviceAuthorised(self.headers):
+            self.reply(401, {"error": "unauthorised"})
+            return
+
+        try:
+            length = int(self.headers.get("Content-Length") or 0)
+            body = json.loads(self.rfile.read(length) or b"{}")
+        except (ValueError, json.JSONDecodeError):
+            self.reply(400, {"error": "body must be json"})
+            return
+        if not isinstance(body, dict):
+            self.reply(400, {"error": "body must be a json object"})
+            return
+
+        country = body.get("country")
+        if country is not None and country not in countries:
+            self.reply(400, {"error": f"unknown country {country}"})
+            return
+        run_countries = [country] if country else countries
+
+        aoids = None
+        if path == "/absences":
+            aoids = body.get("aoids")
+            if not isinstance(aoids, list) or not aoids:
+                self.reply(400, {"error": "aoids must be a non-empty list"})
+                return
+
+        try:
+            results = serviceRun(run_countries, aoids)
+        except Exception as e:
+            print (f"    Service sync failed: {e}")
+            self.reply(500, {"error": str(e)})
+            return
+
+        self.reply(200, {"countries": results})
+
+    def reply(self, status, payload):
+        data = json.dumps(payload).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        print ("    " + format % args)
+
+#---------------------------------------- Top Level Function
+def serve(host, port):
+    ''' Keeps the process resident and answers sync requests until it is stopped
+
+    Args:   host (str): interface to listen on
+            port (int): port to listen on
+    '''
+    server = ThreadingHTTPServer((host, port), ServiceHandler)
+    print (f"Serving event driven absence sync on {host}:{port}")
+    if not service_token:
+        print ("    SERVICE_TOKEN is not set - /trigger and /absences will refuse every request")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
 # Main Function
 
 if __name__ == "__main__":
 
+    parser = argparse.ArgumentParser(description="ADP to Cascade synchronisation")
+    parser.add_argument("--serve", action="store_true", help="stay resident and run the event driven absence sync on request")
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=int(os.environ.get("PORT", 8080)))
+    args, _ = parser.parse_known_args()
+
     if testing is False:
         deleteFolders()                                #clears out at the start of every run. Can be recreated if needed
 
     data_export = debugCheck(debug)
     creds, project_Id = googleAuth()
-    gc = gspread.authorize(creds)
 
     x_months_ago = datetime.now() - timedelta(days=180)
-    storage_client = storage.Client(credentials=creds,project=project_Id)
+    storage_client = getGcpClient("storage")
 
     def country_choice(c,run_type,overnight):
         print ("---------------------------------------------------------------------------------------------------------------")
         print (f"Synchronizing country: {c}")                                           #c represents country. Either USA or CAN
         print (f"Overnight is {overnight}")
 
-        global access_token, cascade_token, certfile, keyfile, strings_to_exclude
-        global Data_export, data_store,country_hierarchy_USA, country_hierarchy_CAN
-        
-        data_store = dataStoreLocation(c)
-        client_id, client_secret, strings_to_exclude, country_hierarchy_USA, country_hierarchy_CAN, cascade_API_id, keyfile, certfile = loadKeys(c)
-        certfile, keyfile = loadSsl(certfile, keyfile)
-        access_token = adpBearer(client_id,client_secret,certfile,keyfile)
-        cascade_token = cascadeBearer (cascade_API_id)
+        prepareCountry(c)
        
         if overnight:
             #----------     Global Data Calls     ----------#
             time_now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
             print ("    Making global calls (" + time_now + ")")
 
-            global adp_responses,adp_terminated,cascade_responses,hierarchy_nodes,ID_library                              
+            global adp_responses,adp_terminated,cascade_responses,cascade_index,hierarchy_nodes,ID_library                              
 
             if testing:
                 load("002 - Security and Global","001 - ADP (Data Out - active).json","adp_responses")
                 load("002 - Security and Global","001 - ADP (Data Out - terminated).json","adp_terminated")
                 load("002 - Security and Global","001 - Cascade Raw Out.json","cascade_responses")
                 load("002 - Security and Global","002 - Hierarchy Nodes.json","hierarchy_nodes")
+                cascade_index = indexCascadeWorkers(cascade_responses)
 
             else:
-                adp_current, adp_leave, adp_terminated    = getWorkersAdp()
+                adp_current, adp_leave, adp_terminated    = getWorkersAdp(run_type)
                 adp_responses = adp_current + adp_leave
-                cascade_responses                           = getWorkersCascade()
+                cascade_responses                           = getWorkersCascade(run_type)
                 hierarchy_nodes                             = getHierarchyList(c)
 
             adpJobCodes                                     = findJobNamesAndCodes(c, adp_responses)
@@ -2860,6 +4753,7 @@ if __name__ == "__main__":
             findAbsenceHierarchy(absence_reasons_raw,prefixes)
             
             ID_library                                      = IDGenerator(c,adp_responses)
+            flushExports()
         else:
             ID_library                                      = import_from_bq(creds,project_Id,c)
             print ("ID library downloaded")
@@ -2873,15 +4767,23 @@ if __name__ == "__main__":
         elif run_type == 4:
             run_type_4()
 
+        flushExports()
+
     countries = ["usa","can"]
     #countries = ["can"]           #Use to test Country independently)
 
-    run_type,overnight = findRunType()
-    print (f"Run type {run_type} - Overnight is {overnight}")
+    if args.serve:
+        serve(args.host, args.port)
+    else:
+        run_type,overnight = findRunType()
+        print (f"Run type {run_type} - Overnight is {overnight}")
 
+        for c in countries:
+            country_choice (c,run_type,overnight)
 
-    for c in countries:
-        country_choice (c,run_type,overnight)
+    flushExports(wait=True)
+    stopTokenRefresh()
+    closeSessions()
 
     ct_fin = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
     print ()